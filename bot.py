@@ -1,19 +1,27 @@
 # bot.py - Main Bot File
 import os
 import asyncio
+import shutil
 import time
 from datetime import datetime
-from pyrogram import Client, filters, enums
+from pyrogram import Client, filters, enums, idle
 from pyrogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     Message, CallbackQuery
 )
 from config import Config
 from helpers.database import Database
+from helpers.cache import SourceCache
+from helpers.prefetch import Prefetcher
+from helpers.transfer import ParallelTransfer, remove_state, DOWNLOAD_CHUNK_SIZE
 from helpers.ffmpeg import FFmpegHelper
-from helpers.progress import progress_message
+from helpers.probe import MediaInfo, probe_cache
+from helpers.progress import progress_updater, transfer_text, encode_text
 from helpers.fsub import check_fsub
-from helpers.utils import humanbytes
+from helpers.utils import format_media_info
+from helpers.scheduler import FairScheduler
+from helpers.workers import WorkerPool
+from helpers import runtime
 import logging
 
 logging.basicConfig(
@@ -28,16 +36,24 @@ app = Client(
     api_id=Config.API_ID,
     api_hash=Config.API_HASH,
     bot_token=Config.BOT_TOKEN,
-    workers=50
+    workers=50,
+    max_concurrent_transmissions=Config.MAX_CONCURRENT_TRANSMISSIONS,
+    plugins=dict(root="handlers")
 )
 
 # Initialize database
 db = Database()
+probe_cache.attach(db)
 
 # Global variables
+source_cache = SourceCache()
+prefetcher = Prefetcher(source_cache)
+transfer = ParallelTransfer(app)
 user_videos = {}
-encoding_queue = asyncio.Queue()
-active_processes = {}
+encoding_queue = FairScheduler()
+active_processes = runtime.active_processes
+# result key -> leader task of identical jobs queued or running
+inflight = {}
 queue_counter = 0
 
 @app.on_message(filters.command("start") & filters.private)
@@ -167,13 +183,17 @@ async def video_handler(client, message: Message):
     media = message.video or message.document
     
     # Store video info
-    user_videos[user_id] = {
-        'message_id': message.id,
-        'file_id': media.file_id,
-        'file_name': getattr(media, 'file_name', f'video_{int(time.time())}.mp4'),
-        'file_size': media.file_size,
-        'duration': getattr(media, 'duration', 0)
-    }
+    user_videos[user_id] = video_info(message)
+    await db.save_user_video(user_id, user_videos[user_id])
+    
+    # Start downloading before an action is picked, the job then reuses the cached bytes
+    prefetcher.start(
+        user_id,
+        media.file_unique_id,
+        media.file_size,
+        lambda path: download_source(media.file_id, media.file_size, path),
+        ext=os.path.splitext(user_videos[user_id]['file_name'] or '')[1] or '.mp4'
+    )
     
     # Create inline buttons - ADD DIRECTLY TO USER'S MESSAGE
     buttons = [
@@ -217,6 +237,119 @@ async def video_handler(client, message: Message):
             reply_to_message_id=message.id
         )
 
+def video_info(message):
+    """Source data of a video or document message, as stored for a user's task"""
+    media = message.video or message.document
+    return {
+        'message_id': message.id,
+        'file_id': media.file_id,
+        'file_name': getattr(media, 'file_name', f'video_{int(time.time())}.mp4'),
+        'file_unique_id': media.file_unique_id,
+        'file_size': media.file_size,
+        'duration': getattr(media, 'duration', 0)
+    }
+
+@app.on_callback_query(filters.regex("^media_info$"))
+async def media_info_callback(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    video_data = user_videos.get(user_id) or await db.get_user_video(user_id)
+    if not video_data:
+        await callback.answer("⚠️ Please send a video first!", show_alert=True)
+        return
+    
+    await callback.answer()
+    status_msg = await callback.message.reply_text("📊 **Fᴇᴛᴄʜɪɴɢ ᴍᴇᴅɪᴀ ɪɴғᴏ...**")
+    await progress_updater.edit(status_msg, await media_info_text(video_data))
+
+@app.on_message(filters.command("mediainfo") & filters.private)
+async def media_info_handler(client, message: Message):
+    if not await check_fsub(client, message, db):
+        return
+    
+    # The replied-to file, or the last one the user sent
+    reply = message.reply_to_message
+    if reply and (reply.video or reply.document):
+        video_data = video_info(reply)
+    else:
+        video_data = user_videos.get(message.from_user.id) or await db.get_user_video(message.from_user.id)
+    
+    if not video_data:
+        await message.reply_text("⚠️ **Rᴇᴘʟʏ ᴛᴏ ᴀ ᴠɪᴅᴇᴏ ᴏʀ sᴇɴᴅ ᴏɴᴇ ғɪʀsᴛ!**")
+        return
+    
+    status_msg = await message.reply_text("📊 **Fᴇᴛᴄʜɪɴɢ ᴍᴇᴅɪᴀ ɪɴғᴏ...**")
+    await progress_updater.edit(status_msg, await media_info_text(video_data))
+
+async def media_info_text(video_data):
+    """Formatted media info of a source, cached per file_unique_id"""
+    file_unique_id = video_data.get('file_unique_id')
+    if file_unique_id:
+        text = await db.get_media_info_text(file_unique_id)
+        if text:
+            return text
+    
+    try:
+        info = await probe_source(video_data)
+    except Exception as e:
+        logger.error(f"Error probing {video_data['file_name']}: {e}")
+        info = None
+    if not info:
+        return "❌ **Uɴᴀʙʟᴇ ᴛᴏ ʀᴇᴀᴅ ᴍᴇᴅɪᴀ ɪɴғᴏ!**"
+    
+    # ffprobe saw a probe or cache path, show the name the user sent
+    info.setdefault('format', {})['filename'] = video_data['file_name']
+    info['format']['size'] = video_data['file_size']
+    text = format_media_info(info)
+    if file_unique_id:
+        await db.save_media_info_text(file_unique_id, text)
+    return text
+
+async def probe_source(video_data):
+    """ffprobe a Telegram source from the head of the file, plus its tail for moov-at-end MP4s
+    
+    The fetched ranges go into a sparse file of the full size. The whole file is only
+    downloaded, through the source cache, when that is not enough for ffprobe.
+    """
+    ffmpeg = FFmpegHelper()
+    file_id = video_data['file_id']
+    file_size = video_data['file_size']
+    cache_key = video_data.get('file_unique_id') or file_id
+    
+    cached_path = source_cache.get(cache_key)
+    if cached_path:
+        return await ffmpeg.get_media_info(cached_path, cache_key)
+    
+    head_size = min(Config.MEDIAINFO_HEAD_CHUNKS * DOWNLOAD_CHUNK_SIZE, file_size)
+    probe_path = os.path.join(Config.DOWNLOAD_DIR, f"{cache_key}_{int(time.time() * 1000)}.probe")
+    try:
+        await transfer.download_ranges(file_id, file_size, probe_path, [(0, head_size)])
+        with open(probe_path, 'rb') as f:
+            head = f.read(head_size)
+        
+        tail_offset = ffmpeg.mp4_tail_offset(head)
+        if tail_offset is not None and head_size < tail_offset < file_size:
+            await transfer.download_ranges(file_id, file_size, probe_path, [(tail_offset, file_size)])
+        
+        info = await ffmpeg.get_media_info(probe_path)
+    finally:
+        remove_file(probe_path)
+    
+    if info and info.get('streams'):
+        return info
+    
+    logger.info(f"Partial probe of {video_data['file_name']} failed, downloading the whole file")
+    path = await source_cache.acquire(
+        cache_key,
+        file_size,
+        lambda part_path: download_source(file_id, file_size, part_path),
+        ext=os.path.splitext(video_data['file_name'] or '')[1] or '.mp4'
+    )
+    probe_cache.alias(path, cache_key)
+    try:
+        return await ffmpeg.get_media_info(path)
+    finally:
+        source_cache.release(cache_key)
+
 # Callback query handler for encoding
 @app.on_callback_query(filters.regex("^encode_"))
 async def encode_callback(client, callback: CallbackQuery):
@@ -224,8 +357,12 @@ async def encode_callback(client, callback: CallbackQuery):
     quality = callback.data.split("_")[1]
     
     if user_id not in user_videos:
-        await callback.answer("⚠️ Please send a video first!", show_alert=True)
-        return
+        # Fall back to the last video saved before a restart
+        video_data = await db.get_user_video(user_id)
+        if not video_data:
+            await callback.answer("⚠️ Please send a video first!", show_alert=True)
+            return
+        user_videos[user_id] = video_data
     
     if user_id in active_processes:
         await callback.answer("⚠️ You have an active process!", show_alert=True)
@@ -236,10 +373,49 @@ async def encode_callback(client, callback: CallbackQuery):
     # Get original message
     video_data = user_videos[user_id]
     
-    # Add to queue
+    # Identical earlier job: re-send its uploads instead of encoding again
+    ffmpeg = FFmpegHelper(await db.get_bot_settings())
+    cache_key = result_key(video_data, quality, ffmpeg)
+    if cache_key and await send_cached_result(user_id, cache_key):
+        prefetcher.cancel(user_id)
+        return
+    
+    is_premium = await db.is_premium_user(user_id)
+    
+    # Add to queue, ids must stay unique across restarts
     global queue_counter
     queue_counter += 1
-    task_id = f"{user_id}_{queue_counter}"
+    task_id = f"{user_id}_{int(time.time())}{queue_counter}"
+    
+    # Same source and operation already in flight: attach to it instead of encoding twice,
+    # a user is never attached to their own job
+    leader = inflight.get(cache_key) if cache_key else None
+    if leader and leader['user_id'] != user_id:
+        status_msg = await callback.message.reply_text(
+            f"🔗 **Aᴛᴛᴀᴄʜᴇᴅ ᴛᴏ ᴀɴ ɪᴅᴇɴᴛɪᴄᴀʟ ᴊᴏʙ!**\n\n"
+            f"🎯 **Qᴜᴀʟɪᴛʏ:** {quality.upper()}\n\n"
+            f"⏳ **Yᴏᴜ ᴡɪʟʟ ʀᴇᴄᴇɪᴠᴇ ᴛʜᴇ ʀᴇsᴜʟᴛ ᴡʜᴇɴ ɪᴛ ғɪɴɪsʜᴇs...**"
+        )
+        
+        # Persisted on its own, after a restart it is recovered as a normal job
+        await db.add_job(task_id, {
+            'user_id': user_id,
+            'quality': quality,
+            'premium': is_premium,
+            'video_data': dict(video_data),
+            'chat_id': status_msg.chat.id,
+            'status_msg_id': status_msg.id,
+            'leader': leader['task_id']
+        })
+        
+        prefetcher.cancel(user_id)
+        active_processes[user_id] = task_id
+        leader['followers'].append({
+            'user_id': user_id,
+            'task_id': task_id,
+            'status_msg': status_msg
+        })
+        return
     
     # Reply to original video with processing status
     status_msg = await callback.message.reply_text(
@@ -249,189 +425,639 @@ async def encode_callback(client, callback: CallbackQuery):
         f"⏳ **Pʀᴏᴄᴇssɪɴɢ ᴡɪʟʟ sᴛᴀʀᴛ sᴏᴏɴ...**"
     )
     
+    # Persist the job so it survives restarts
+    await db.add_job(task_id, {
+        'user_id': user_id,
+        'quality': quality,
+        'premium': is_premium,
+        'video_data': dict(video_data),
+        'chat_id': status_msg.chat.id,
+        'status_msg_id': status_msg.id
+    })
+    # Listed as the user's task so its lease is renewed while it waits
+    active_processes[user_id] = task_id
+    
     # Add to encoding queue
-    await encoding_queue.put({
+    task = {
         'user_id': user_id,
         'task_id': task_id,
         'quality': quality,
+        'premium': is_premium,
+        'video_data': dict(video_data),
         'callback': callback,
-        'status_msg': status_msg
-    })
-
-# Queue processor
-async def queue_processor():
-    while True:
-        try:
-            task = await encoding_queue.get()
-            user_id = task['user_id']
-            quality = task['quality']
-            status_msg = task['status_msg']
-            task_id = task['task_id']
-            
-            # Mark as active
-            active_processes[user_id] = task_id
-            
-            # Start encoding
-            await process_encoding(user_id, quality, task_id, status_msg)
-            
-            # Remove from active
-            if user_id in active_processes:
-                del active_processes[user_id]
-            
-            encoding_queue.task_done()
-            
-        except Exception as e:
-            logger.error(f"Queue processor error: {e}")
-            if user_id in active_processes:
-                del active_processes[user_id]
+        'status_msg': status_msg,
+        'flight_key': cache_key,
+        'followers': []
+    }
+    if cache_key:
+        inflight[cache_key] = task
+    prefetcher.keep(user_id)
+    await encoding_queue.put(task)
 
-async def process_encoding(user_id, quality, task_id, status_msg):
+# Pipeline stages: download -> encode -> upload, each with its own pool
+async def download_stage(task):
+    user_id = task['user_id']
+    task_id = task['task_id']
+    status_msg = task['status_msg']
+    video_data = task['video_data']
+    
+    # Mark as active until the task leaves the last stage
+    active_processes[user_id] = task_id
+    
     try:
-        video_data = user_videos.get(user_id)
-        if not video_data:
-            await status_msg.edit_text("❌ Video data not found!")
+        if not await claim_task(task, 'downloading'):
             return
         
         file_name = video_data['file_name']
         file_size = video_data['file_size']
+        cache_key = video_data.get('file_unique_id') or video_data['file_id']
+        
+        # Progressive sources skip ahead and are encoded while they download
+        stream_info = await probe_stream(task, cache_key)
+        if stream_info:
+            task['stream_info'] = stream_info
+            prefetcher.cancel(user_id)
+            await progress_updater.edit(
+                status_msg,
+                f"⏳ **Wᴀɪᴛɪɴɢ ғᴏʀ ᴀɴ ᴇɴᴄᴏᴅᴇ sʟᴏᴛ...**\n\n"
+                f"`{file_name}`\n\n"
+                f"📡 **Sᴛʀᴇᴀᴍɪɴɢ:** download and encode run together\n"
+                f"📊 **Eɴᴄᴏᴅᴇ Qᴜᴇᴜᴇ:** {encoding_pool.qsize() + 1}"
+            )
+            await encoding_pool.put(task)
+            return
         
         # Download video with progress
         start_time = time.time()
         
-        await status_msg.edit_text(
-            f"**1. Dᴏᴡɴʟᴏᴀᴅɪɴɢ**\n\n"
-            f"`{file_name}`\n\n"
-            f"╭──「 ●□□□□□□□□□ 」── 0%\n"
-            f"├ **Sᴘᴇᴇᴅ:** Calculating...\n"
-            f"├ **Sɪᴢᴇ:** 0 B / {humanbytes(file_size)}\n"
-            f"├ **ETA:** Calculating...\n"
-            f"├ **Eʟᴀᴘsᴇᴅ:** 00:00:00\n"
-            f"├ **Tᴀsᴋ Bʏ:** User\n"
-            f"╰ **Usᴇʀ ID:** `{user_id}`\n\n"
-            f"`/stop{task_id}`"
+        await progress_updater.edit(
+            status_msg,
+            transfer_text("1. Dᴏᴡɴʟᴏᴀᴅɪɴɢ", 0, file_size, start_time, file_name, user_id, task_id)
         )
         
-        download_path = f"downloads/{user_id}_{int(time.time())}.mp4"
-        os.makedirs("downloads", exist_ok=True)
-        
-        # Simulate download with progress (replace with actual download)
         async def download_progress(current, total):
-            percent = (current / total) * 100
-            speed = current / (time.time() - start_time) if (time.time() - start_time) > 0 else 0
-            eta = (total - current) / speed if speed > 0 else 0
-            elapsed = time.time() - start_time
-            
-            bar = "●" * int(percent / 10) + "□" * (10 - int(percent / 10))
-            
-            await status_msg.edit_text(
-                f"**1. Dᴏᴡɴʟᴏᴀᴅɪɴɢ**\n\n"
-                f"`{file_name}`\n\n"
-                f"╭──「 {bar} 」── {percent:.1f}%\n"
-                f"├ **Sᴘᴇᴇᴅ:** {humanbytes(speed)}/s\n"
-                f"├ **Sɪᴢᴇ:** {humanbytes(current)} / {humanbytes(total)}\n"
-                f"├ **ETA:** {int(eta)}s\n"
-                f"├ **Eʟᴀᴘsᴇᴅ:** {int(elapsed)}s\n"
-                f"├ **Tᴀsᴋ Bʏ:** User\n"
-                f"╰ **Usᴇʀ ID:** `{user_id}`\n\n"
-                f"`/stop{task_id}`"
+            progress_updater.update(
+                status_msg,
+                transfer_text("1. Dᴏᴡɴʟᴏᴀᴅɪɴɢ", current, total, start_time, file_name, user_id, task_id)
             )
         
-        # Download file
-        downloaded_file = await app.download_media(
-            video_data['file_id'],
-            file_name=download_path,
-            progress=download_progress
+        async def fetch(path):
+            return await download_source(video_data['file_id'], file_size, path, download_progress)
+        
+        # Download file, or reuse the cached source of an earlier task
+        release_source(task)
+        task['download_path'] = await source_cache.acquire(
+            cache_key,
+            file_size,
+            fetch,
+            ext=os.path.splitext(file_name or '')[1] or '.mp4'
+        )
+        task['cache_key'] = cache_key
+        probe_cache.alias(task['download_path'], cache_key)
+        
+        # The job holds its own pin now, a prefetch of this source is no longer needed
+        prefetcher.cancel(user_id)
+        
+        await progress_updater.edit(
+            status_msg,
+            f"⏳ **Wᴀɪᴛɪɴɢ ғᴏʀ ᴀɴ ᴇɴᴄᴏᴅᴇ sʟᴏᴛ...**\n\n"
+            f"`{file_name}`\n\n"
+            f"📊 **Eɴᴄᴏᴅᴇ Qᴜᴇᴜᴇ:** {encoding_pool.qsize() + 1}"
         )
+        await encoding_pool.put(task)
         
-        # Encoding phase
-        encode_start = time.time()
-        output_path = f"encoded/{user_id}_{quality}_{int(time.time())}.mp4"
-        os.makedirs("encoded", exist_ok=True)
+    except Exception as e:
+        await fail_task(task, e, retry_pool=download_pool)
+
+async def encode_stage(task):
+    user_id = task['user_id']
+    task_id = task['task_id']
+    quality = task['quality']
+    status_msg = task['status_msg']
+    file_name = task['video_data']['file_name']
+    
+    try:
+        if not await claim_task(task, 'encoding'):
+            return
         
-        await status_msg.edit_text(
+        ffmpeg = FFmpegHelper(await db.get_bot_settings())
+        task['result_key'] = result_key(task['video_data'], quality, ffmpeg)
+        
+        # Streamed tasks were probed from the head of the source, which is not downloaded yet
+        stream_info = task.pop('stream_info', None)
+        
+        # Encoding phase, ALL produces every rung of the ladder the source can fill
+        qualities = list(Config.QUALITIES) if quality == 'all' else [quality]
+        info = stream_info or await ffmpeg.get_media_info(task['download_path'])
+        ladder, skipped = ffmpeg.select_ladder(info, qualities)
+        task['skipped'] = skipped
+        
+        # Outputs of a failed earlier attempt are written again under new names
+        for output_path in task.pop('outputs', {}).values():
+            remove_file(output_path)
+        
+        os.makedirs(Config.ENCODE_DIR, exist_ok=True)
+        outputs = {
+            q: f"{Config.ENCODE_DIR}/{task_id}_{q}_{int(time.time())}.mp4"
+            for q in ladder
+        }
+        task['outputs'] = outputs
+        
+        skipped_text = f"⏭ **Sᴋɪᴘᴘᴇᴅ:** {', '.join(skipped)} (above source)\n" if skipped else ""
+        
+        await progress_updater.edit(
+            status_msg,
             f"**2. Eɴᴄᴏᴅɪɴɢ** ⚙️\n\n"
             f"`{file_name}`\n\n"
-            f"🎯 **Qᴜᴀʟɪᴛʏ:** {quality.upper()}\n"
+            f"🎯 **Qᴜᴀʟɪᴛʏ:** {', '.join(ladder).upper()}\n"
+            f"{skipped_text}"
             f"⏱ **Pʀᴏɢʀᴇss:** Starting...\n\n"
             f"╭ **Tᴀsᴋ Bʏ:** User\n"
             f"╰ **Usᴇʀ ID:** `{user_id}`\n\n"
             f"`/stop{task_id}`"
         )
         
-        # Call FFmpeg encoding (implement in helpers/ffmpeg.py)
-        ffmpeg = FFmpegHelper()
-        success = await ffmpeg.encode_video(
-            downloaded_file,
-            output_path,
-            quality,
-            progress_callback=lambda p: update_encode_progress(status_msg, p, file_name, quality, user_id, task_id)
-        )
+        progress_callback = lambda p: update_encode_progress(status_msg, p, file_name, quality, user_id, task_id)
+        
+        # Rungs the source already satisfies are remuxed instead of re-encoded
+        paths = {q: ffmpeg.plan_encode(info, ladder[q]) for q in ladder}
+        task['paths'] = paths
+        success = True
+        
+        if stream_info:
+            try:
+                streamed = await stream_encode(task, ffmpeg, stream_info, ladder, progress_callback)
+            except Exception as e:
+                # Download errors are retried as a normal download
+                task['no_stream'] = True
+                await fail_task(task, e, retry_pool=download_pool)
+                return
+            
+            if streamed:
+                release_source(task)
+                await upload_pool.put(task)
+                return
+            
+            # Not every source that looks progressive decodes from a pipe, encode the downloaded copy
+            logger.warning(f"Streamed encode of {task_id} failed, retrying from the downloaded source")
+        
+        for output_quality, path in paths.items():
+            if path != 'encode' and success:
+                success = await ffmpeg.remux_video(
+                    task['download_path'],
+                    outputs[output_quality],
+                    encode_audio=(path == 'audio')
+                )
+        
+        to_encode = [q for q in ladder if paths[q] == 'encode']
+        if success and to_encode and quality == 'all':
+            # One decode feeds every rung instead of one full encode per quality
+            success = await ffmpeg.encode_ladder(
+                task['download_path'],
+                {q: outputs[q] for q in to_encode},
+                progress_callback=progress_callback,
+                ladder=ladder
+            )
+        elif success and to_encode:
+            # A rung above the source is clamped to the best one it can fill
+            output_quality = to_encode[0]
+            success = await ffmpeg.encode_video_segmented(
+                task['download_path'],
+                outputs[output_quality],
+                output_quality,
+                progress_callback=progress_callback,
+                quality_settings=ladder[output_quality],
+                work_dir=f"{Config.ENCODE_DIR}/{task_id}_segments"
+            )
         
         if not success:
-            await status_msg.edit_text("❌ **Eɴᴄᴏᴅɪɴɢ Fᴀɪʟᴇᴅ!**")
+            # The segment checkpoints stay in place, a retry only encodes what is missing
+            await fail_task(task, 'Encoding failed', retry_pool=encoding_pool)
+            return
+        
+        # The source stays cached for later tasks but may be evicted now
+        release_source(task)
+        
+        await upload_pool.put(task)
+        
+    except Exception as e:
+        await fail_task(task, e, retry_pool=encoding_pool)
+
+async def upload_stage(task):
+    user_id = task['user_id']
+    quality = task['quality']
+    status_msg = task['status_msg']
+    file_name = task['video_data']['file_name']
+    
+    try:
+        if not await claim_task(task, 'uploading'):
             return
         
         # Upload phase
-        await status_msg.edit_text(
-            f"**3. Uᴘʟᴏᴀᴅɪɴɢ** 📤\n\n"
-            f"`{file_name}`\n\n"
-            f"╭──「 ●□□□□□□□□□ 」── 0%\n"
-            f"├ **Sᴘᴇᴇᴅ:** Calculating...\n"
-            f"├ **ETA:** Calculating...\n"
-            f"╰ **Usᴇʀ ID:** `{user_id}`"
+        start_time = time.time()
+        await progress_updater.edit(
+            status_msg,
+            transfer_text("3. Uᴘʟᴏᴀᴅɪɴɢ 📤", 0, 0, start_time, file_name, user_id)
         )
         
+        async def progress(current, total):
+            upload_progress(status_msg, current, total, file_name, user_id, start_time)
+        
         # Upload encoded file
         user_settings = await db.get_user_settings(user_id)
         thumb = user_settings.get('thumbnail') if user_settings else None
         
-        await app.send_video(
-            chat_id=user_id,
-            video=output_path,
-            caption=f"✅ **Eɴᴄᴏᴅᴇᴅ Sᴜᴄᴄᴇssғᴜʟʟʏ!**\n\n🎯 **Qᴜᴀʟɪᴛʏ:** {quality.upper()}",
-            thumb=thumb,
-            progress=lambda c, t: upload_progress(status_msg, c, t, file_name, user_id)
-        )
+        skipped = task.get('skipped')
+        skipped_text = f"\n⏭ **Sᴋɪᴘᴘᴇᴅ:** {', '.join(skipped)} (above source)" if skipped else ""
+        path_names = {'copy': 'Stream copy', 'audio': 'Audio re-encode', 'encode': 'Full encode'}
+        
+        uploaded = []
+        for output_quality, output_path in task['outputs'].items():
+            path = path_names[task.get('paths', {}).get(output_quality, 'encode')]
+            caption = (
+                f"✅ **Eɴᴄᴏᴅᴇᴅ Sᴜᴄᴄᴇssғᴜʟʟʏ!**\n\n"
+                f"🎯 **Qᴜᴀʟɪᴛʏ:** {output_quality.upper()}\n"
+                f"⚡ **Pᴀᴛʜ:** {path}{skipped_text}"
+            )
+            sent = await send_output(
+                user_id,
+                output_path,
+                caption,
+                thumb,
+                progress
+            )
+            
+            media = sent.video or sent.document
+            uploaded.append({'quality': output_quality, 'file_id': media.file_id, 'caption': caption})
         
-        # Cleanup
-        os.remove(downloaded_file)
-        os.remove(output_path)
+        task['uploaded'] = uploaded
+        if task.get('result_key'):
+            await db.save_cached_result(task['result_key'], uploaded)
         
-        await status_msg.delete()
+        await progress_updater.delete(status_msg)
+        await finish_task(task, 'done')
         
     except Exception as e:
-        logger.error(f"Encoding error: {e}")
-        await status_msg.edit_text(f"❌ **Eʀʀᴏʀ:** {str(e)}")
+        await fail_task(task, e, retry_pool=upload_pool)
 
-async def update_encode_progress(msg, progress, file_name, quality, user_id, task_id):
-    await msg.edit_text(
-        f"**2. Eɴᴄᴏᴅɪɴɢ** ⚙️\n\n"
-        f"`{file_name}`\n\n"
-        f"🎯 **Qᴜᴀʟɪᴛʏ:** {quality.upper()}\n"
-        f"⏱ **Pʀᴏɢʀᴇss:** {progress}%\n\n"
-        f"╭ **Tᴀsᴋ Bʏ:** User\n"
-        f"╰ **Usᴇʀ ID:** `{user_id}`\n\n"
-        f"`/stop{task_id}`"
+async def probe_stream(task, cache_key):
+    """Media info from the head of a source that can be encoded while it downloads, else None"""
+    video_data = task['video_data']
+    if not Config.STREAMING_INGEST or task['quality'] == 'all' or task.get('no_stream'):
+        return None
+    if source_cache.get(cache_key) or cache_key in source_cache.fetching:
+        return None
+    
+    head = b''
+    async for chunk in app.stream_media(video_data['file_id'], limit=Config.STREAM_HEAD_CHUNKS):
+        head += chunk
+    
+    ffmpeg = FFmpegHelper()
+    if not ffmpeg.is_streamable(head):
+        return None
+    
+    head_path = os.path.join(Config.DOWNLOAD_DIR, f"{task['task_id']}.head")
+    try:
+        with open(head_path, 'wb') as f:
+            f.write(head)
+        info = await ffmpeg.get_media_info(head_path)
+    finally:
+        remove_file(head_path)
+    
+    if not info or not info.get('streams'):
+        return None
+    
+    # Segmented encoding of long sources needs the whole file up front
+    duration = MediaInfo(info).duration or video_data.get('duration') or 0
+    if Config.SEGMENTED_ENCODING and duration >= Config.SEGMENT_MIN_DURATION:
+        return None
+    return info
+
+async def stream_encode(task, ffmpeg, info, ladder, progress_callback):
+    """Encode the single rung of a task from the download stream
+    
+    The stream is written to the source cache on the way, so the source is kept
+    for later tasks and for a retry from the file. Returns whether ffmpeg succeeded,
+    or None if the source was already being fetched by another task.
+    """
+    video_data = task['video_data']
+    output_quality = next(iter(ladder))
+    path = task['paths'][output_quality]
+    output_path = task['outputs'][output_quality]
+    duration = MediaInfo(info).duration or video_data.get('duration') or 0
+    result = None
+    
+    async def fetch(part_path):
+        nonlocal result
+        with open(part_path, 'wb') as f:
+            async def chunks():
+                async for chunk in app.stream_media(video_data['file_id']):
+                    f.write(chunk)
+                    yield chunk
+            
+            stream = chunks()
+            if path == 'encode':
+                result = await ffmpeg.encode_video(
+                    'pipe:0', output_path, output_quality, progress_callback,
+                    ladder[output_quality], stdin=stream, duration=duration
+                )
+            else:
+                result = await ffmpeg.remux_video(
+                    'pipe:0', output_path, encode_audio=(path == 'audio'),
+                    progress_callback=progress_callback, stdin=stream, duration=duration
+                )
+            
+            # ffmpeg may stop reading early, the rest still goes to the cache
+            async for _ in stream:
+                pass
+        
+        if video_data['file_size'] and os.path.getsize(part_path) != video_data['file_size']:
+            raise RuntimeError("Download stream ended early")
+        return part_path
+    
+    release_source(task)
+    cache_key = video_data.get('file_unique_id') or video_data['file_id']
+    task['download_path'] = await source_cache.acquire(
+        cache_key,
+        video_data['file_size'],
+        fetch,
+        ext=os.path.splitext(video_data['file_name'] or '')[1] or '.mp4'
     )
+    task['cache_key'] = cache_key
+    probe_cache.alias(task['download_path'], cache_key)
+    return result
 
-async def upload_progress(msg, current, total, file_name, user_id):
-    percent = (current / total) * 100
-    bar = "●" * int(percent / 10) + "□" * (10 - int(percent / 10))
+async def download_source(file_id, file_size, path, progress=None):
+    """Download a source, over several connections when it is large"""
+    if file_size and file_size >= Config.PARALLEL_TRANSFER_MIN_SIZE:
+        return await transfer.download(file_id, file_size, path, progress)
+    return await app.download_media(file_id, file_name=path, progress=progress)
+
+async def send_output(chat_id, path, caption, thumb=None, progress=None):
+    """Send an encoded video, uploading it over several connections when it is large"""
+    if os.path.getsize(path) < Config.PARALLEL_TRANSFER_MIN_SIZE:
+        return await app.send_video(chat_id=chat_id, video=path, caption=caption, thumb=thumb, progress=progress)
     
-    await msg.edit_text(
-        f"**3. Uᴘʟᴏᴀᴅɪɴɢ** 📤\n\n"
-        f"`{file_name}`\n\n"
-        f"╭──「 {bar} 」── {percent:.1f}%\n"
-        f"├ **Sɪᴢᴇ:** {humanbytes(current)} / {humanbytes(total)}\n"
-        f"╰ **Usᴇʀ ID:** `{user_id}`"
+    info = await FFmpegHelper().probe(path)
+    return await transfer.send_video(
+        chat_id,
+        path,
+        caption,
+        thumb=thumb,
+        duration=info.duration if info else 0,
+        width=info.width if info else 0,
+        height=info.height if info else 0,
+        progress=progress
     )
 
-# Start queue processor on bot start
+def result_key(video_data, quality, ffmpeg):
+    """Key of an encode result: source, operation, quality and encoder settings"""
+    file_unique_id = video_data.get('file_unique_id')
+    if not file_unique_id:
+        return None
+    return f"{file_unique_id}:encode:{quality}:{ffmpeg.settings_hash()}"
+
+async def send_cached_result(user_id, cache_key):
+    """Deliver cached uploads by file_id, returns False on a miss"""
+    outputs = await db.get_cached_result(cache_key)
+    if not outputs:
+        return False
+    
+    try:
+        for output in outputs:
+            await app.send_cached_media(
+                chat_id=user_id,
+                file_id=output['file_id'],
+                caption=f"{output['caption']}\n♻️ **Dᴇʟɪᴠᴇʀᴇᴅ ғʀᴏᴍ ᴄᴀᴄʜᴇ**"
+            )
+        return True
+    except Exception as e:
+        # Stale file_id, fall back to a normal encode
+        logger.error(f"Error sending cached result {cache_key}: {e}")
+        return False
+
+def remove_file(path):
+    """Remove a temporary file if it exists"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+async def claim_task(task, state):
+    """Lease the persisted job for this worker and record its stage"""
+    if not await db.lease_job(task['task_id'], Config.WORKER_ID, Config.JOB_LEASE_SECONDS):
+        logger.warning(f"Task {task['task_id']} is leased by another worker, skipping")
+        release_task(task)
+        await settle_followers(task, 'failed', 'Job was taken over by another worker')
+        return False
+    
+    await db.set_job_state(task['task_id'], state)
+    return True
+
+def release_task(task):
+    """Release the user so they can start another task"""
+    if active_processes.get(task['user_id']) == task['task_id']:
+        del active_processes[task['user_id']]
+
+def release_source(task):
+    """Unpin the task's cached source"""
+    task.pop('download_path', None)
+    cache_key = task.pop('cache_key', None)
+    if cache_key:
+        source_cache.release(cache_key)
+
+def cleanup_task(task):
+    """Release the task's source and remove its outputs and segment checkpoints"""
+    release_source(task)
+    for output_path in task.pop('outputs', {}).values():
+        remove_file(output_path)
+        remove_state(output_path)
+    shutil.rmtree(f"{Config.ENCODE_DIR}/{task['task_id']}_segments", ignore_errors=True)
+
+async def finish_task(task, state, error=None):
+    cleanup_task(task)
+    release_task(task)
+    await db.finish_job(task['task_id'], state, error)
+    await settle_followers(task, state, error)
+
+async def settle_followers(task, state, error=None):
+    """Hand the outcome of a task to every identical job attached to it"""
+    if task.get('flight_key') and inflight.get(task['flight_key']) is task:
+        del inflight[task['flight_key']]
+    
+    for follower in task.pop('followers', []):
+        try:
+            if state == 'done':
+                for output in task.get('uploaded', []):
+                    await app.send_cached_media(
+                        chat_id=follower['user_id'],
+                        file_id=output['file_id'],
+                        caption=output['caption']
+                    )
+                await progress_updater.delete(follower['status_msg'])
+            else:
+                await progress_updater.edit(follower['status_msg'], f"❌ **Eʀʀᴏʀ:** {error or state}")
+            await db.finish_job(follower['task_id'], state, error)
+        except Exception as e:
+            logger.error(f"Error settling follower {follower['task_id']}: {e}")
+        finally:
+            release_task(follower)
+
+async def fail_task(task, error, retry_pool=None):
+    logger.error(f"Task {task['task_id']} failed: {error}")
+    
+    try:
+        if retry_pool:
+            # Files of finished stages are kept, the task resumes at the failed stage
+            attempts = await db.retry_job(task['task_id'], str(error))
+            if attempts <= Config.MAX_JOB_RETRIES:
+                await progress_updater.edit(
+                    task['status_msg'],
+                    f"⚠️ **Eʀʀᴏʀ:** {str(error)}\n\n"
+                    f"🔁 **Rᴇᴛʀʏɪɴɢ** ({attempts}/{Config.MAX_JOB_RETRIES})..."
+                )
+                # Never waits, a worker blocked on its own full queue would stall the stage
+                retry_pool.put_nowait(task)
+                return
+        
+        await finish_task(task, 'failed', str(error))
+        await progress_updater.edit(task['status_msg'], f"❌ **Eʀʀᴏʀ:** {str(error)}")
+    except Exception as e:
+        release_task(task)
+        logger.error(f"Error reporting failure of {task['task_id']}: {e}")
+
+async def recover_jobs(boot=True):
+    """Re-queue jobs that were pending or interrupted by a restart
+    
+    At boot this worker's own jobs are taken back too. Later sweeps only take jobs
+    whose worker let the lease expire.
+    """
+    jobs = await (await db.get_recoverable_jobs(Config.WORKER_ID, include_own=boot)).to_list(length=None)
+    held = set(active_processes.values())
+    recovered = 0
+    
+    for job in jobs:
+        try:
+            # Another worker sweeping at the same time may claim it first
+            if job['_id'] in held or not await db.lease_job(job['_id'], Config.WORKER_ID, Config.JOB_LEASE_SECONDS):
+                continue
+            
+            if job['state'] != 'queued':
+                attempts = await db.retry_job(job['_id'], 'Interrupted by restart' if boot else 'Worker lease expired')
+                if attempts > Config.MAX_JOB_RETRIES:
+                    await db.finish_job(job['_id'], 'failed', 'Interrupted too many times')
+                    await app.send_message(
+                        job['chat_id'],
+                        f"❌ **Tᴀsᴋ Fᴀɪʟᴇᴅ!**\n\n"
+                        f"`{job['video_data']['file_name']}` was interrupted too many times."
+                    )
+                    continue
+            
+            text = (
+                f"♻️ **{'Bᴏᴛ Rᴇsᴛᴀʀᴛᴇᴅ' if boot else 'Tᴀsᴋ Rᴇᴄᴏᴠᴇʀᴇᴅ'}!**\n\n"
+                f"`{job['video_data']['file_name']}`\n\n"
+                f"🎯 **Qᴜᴀʟɪᴛʏ:** {job['quality'].upper()}\n"
+                f"⏳ **Yᴏᴜʀ ᴛᴀsᴋ ʜᴀs ʙᴇᴇɴ ʀᴇ-ǫᴜᴇᴜᴇᴅ...**"
+            )
+            
+            try:
+                status_msg = await app.get_messages(job['chat_id'], job['status_msg_id'])
+                status_msg = await status_msg.edit_text(text)
+            except Exception:
+                status_msg = await app.send_message(job['chat_id'], text)
+            
+            # Listed as the user's task so its lease is renewed while it waits
+            active_processes[job['user_id']] = job['_id']
+            recovered += 1
+            await encoding_queue.put({
+                'user_id': job['user_id'],
+                'task_id': job['_id'],
+                'quality': job['quality'],
+                'premium': job.get('premium', False),
+                'video_data': job['video_data'],
+                'callback': None,
+                'status_msg': status_msg
+            })
+        except Exception as e:
+            logger.error(f"Error recovering job {job['_id']}: {e}")
+    
+    if recovered:
+        logger.info(f"Recovered {recovered} jobs from the database")
+
+async def renew_leases():
+    """Keep leases of running jobs alive"""
+    while True:
+        await asyncio.sleep(Config.JOB_LEASE_SECONDS / 3)
+        for task_id in list(active_processes.values()):
+            try:
+                await db.lease_job(task_id, Config.WORKER_ID, Config.JOB_LEASE_SECONDS)
+            except Exception as e:
+                logger.error(f"Error renewing lease of {task_id}: {e}")
+
+async def sweep_jobs():
+    """Take over jobs of workers whose leases expired while this one runs"""
+    while True:
+        await asyncio.sleep(Config.JOB_LEASE_SECONDS)
+        try:
+            await recover_jobs(boot=False)
+        except Exception as e:
+            logger.error(f"Error sweeping expired jobs: {e}")
+
+download_pool = WorkerPool(
+    "download", download_stage, Config.DOWNLOAD_WORKERS,
+    queue=encoding_queue, reserved=Config.PREMIUM_RESERVED_WORKERS
+)
+# Jobs only hold files once downloaded, so the later stages are bounded and a full
+# queue holds back the stage before it
+encoding_pool = WorkerPool(
+    "encode", encode_stage, Config.ENCODE_WORKERS,
+    reserved=Config.PREMIUM_RESERVED_WORKERS, maxsize=Config.STAGE_QUEUE_SIZE
+)
+upload_pool = WorkerPool(
+    "upload", upload_stage, Config.UPLOAD_WORKERS,
+    reserved=Config.PREMIUM_RESERVED_WORKERS, maxsize=Config.STAGE_QUEUE_SIZE
+)
+pipeline = runtime.pipeline
+pipeline.update({
+    'download': download_pool,
+    'encode': encoding_pool,
+    'upload': upload_pool
+})
+runtime.finish_task = finish_task
+
+def update_encode_progress(msg, progress, file_name, quality, user_id, task_id):
+    progress_updater.update(msg, encode_text(progress, file_name, quality, user_id, task_id))
+
+def upload_progress(msg, current, total, file_name, user_id, start_time):
+    progress_updater.update(msg, transfer_text("3. Uᴘʟᴏᴀᴅɪɴɢ 📤", current, total, start_time, file_name, user_id))
+
+# Start queue processor if it is not running
 @app.on_message(filters.command("run_queue") & filters.user(Config.ADMIN_ID))
 async def start_queue(client, message):
-    asyncio.create_task(queue_processor())
+    if all(pool.running for pool in pipeline.values()):
+        await message.reply_text("ℹ️ Queue processor is already running!")
+        return
+    
+    for pool in pipeline.values():
+        if not pool.running:
+            pool.start()
     await message.reply_text("✅ Queue processor started!")
 
+async def main():
+    await app.start()
+    for pool in pipeline.values():
+        pool.start()
+    lease_task = asyncio.create_task(renew_leases())
+    await recover_jobs()
+    sweep_task = asyncio.create_task(sweep_jobs())
+    logger.info("Bot started with " + ", ".join(f"{name}: {pool.size}" for name, pool in pipeline.items()) + " workers")
+    
+    await idle()
+    
+    lease_task.cancel()
+    sweep_task.cancel()
+    for pool in pipeline.values():
+        await pool.stop()
+    await app.stop()
+
 # Run bot
 if __name__ == "__main__":
-    app.run()
+    app.run(main())
@@ -1,4 +1,5 @@
 import os
+import socket
 from os import environ
 
 class Config:
@@ -44,9 +45,12 @@ class Config:
     DOWNLOAD_DIR = environ.get("DOWNLOAD_DIR", "downloads")
     ENCODE_DIR = environ.get("ENCODE_DIR", "encoded")
     THUMB_DIR = environ.get("THUMB_DIR", "thumbnails")
+    CACHE_DIR = environ.get("CACHE_DIR", "cache")
     
     # Limits
     MAX_FILE_SIZE = int(environ.get("MAX_FILE_SIZE", "4294967296"))  # 4GB
+    CACHE_MAX_BYTES = int(environ.get("CACHE_MAX_BYTES", "21474836480"))  # 20GB of cached sources
+    CACHE_PARTIAL_TTL = int(environ.get("CACHE_PARTIAL_TTL", "86400"))  # seconds a resumable partial download is kept
     MAX_QUEUE_SIZE = int(environ.get("MAX_QUEUE_SIZE", "10"))
     FREE_USER_LIMIT = int(environ.get("FREE_USER_LIMIT", "5"))  # Per day
     
@@ -65,8 +69,60 @@ class Config:
     
     # Misc
     MAX_CONCURRENT_TASKS = int(environ.get("MAX_CONCURRENT_TASKS", "3"))
+    
+    # Pipeline stage workers (downloads and uploads are network bound, encodes CPU bound)
+    DOWNLOAD_WORKERS = int(environ.get("DOWNLOAD_WORKERS", "4"))
+    ENCODE_WORKERS = int(environ.get("ENCODE_WORKERS", str(MAX_CONCURRENT_TASKS)))
+    UPLOAD_WORKERS = int(environ.get("UPLOAD_WORKERS", "2"))
+    STAGE_QUEUE_SIZE = int(environ.get("STAGE_QUEUE_SIZE", "2"))  # finished jobs of each tier waiting for the encode or upload stage
+    
+    # Segmented encoding (long inputs are split at keyframes and encoded in parallel)
+    SEGMENTED_ENCODING = environ.get("SEGMENTED_ENCODING", "True").lower() == "true"
+    SEGMENT_DURATION = int(environ.get("SEGMENT_DURATION", "60"))  # seconds
+    SEGMENT_MIN_DURATION = int(environ.get("SEGMENT_MIN_DURATION", "600"))  # seconds
+    SEGMENT_THREADS = int(environ.get("SEGMENT_THREADS", "2"))  # per segment encoder
+    
+    # Smart cut (trims re-encode only the partial GOPs at both ends and copy the rest)
+    SMART_CUT = environ.get("SMART_CUT", "True").lower() == "true"
+    
+    # Streaming ingest (progressive sources are encoded while they download)
+    STREAMING_INGEST = environ.get("STREAMING_INGEST", "True").lower() == "true"
+    STREAM_HEAD_CHUNKS = int(environ.get("STREAM_HEAD_CHUNKS", "2"))  # 1MB chunks probed up front
+    MEDIAINFO_HEAD_CHUNKS = int(environ.get("MEDIAINFO_HEAD_CHUNKS", "2"))  # 1MB chunks fetched for media info
+    
+    # Speculative prefetch (sources start downloading as soon as they are sent)
+    PREFETCH = environ.get("PREFETCH", "True").lower() == "true"
+    PREFETCH_WORKERS = int(environ.get("PREFETCH_WORKERS", "2"))  # concurrent prefetch downloads
+    PREFETCH_TTL = int(environ.get("PREFETCH_TTL", "300"))  # seconds to wait for an action
+    PREFETCH_MAX_SIZE = int(environ.get("PREFETCH_MAX_SIZE", "2147483648"))  # 2GB
+    
+    # Parallel transfers (large files move over several concurrent connections)
+    TRANSFER_CONNECTIONS = int(environ.get("TRANSFER_CONNECTIONS", "4"))
+    TRANSFER_BLOCK_CHUNKS = int(environ.get("TRANSFER_BLOCK_CHUNKS", "16"))  # 1MB chunks per download range
+    PARALLEL_TRANSFER_MIN_SIZE = int(environ.get("PARALLEL_TRANSFER_MIN_SIZE", "67108864"))  # 64MB
+    TRANSFER_RETRIES = int(environ.get("TRANSFER_RETRIES", "5"))  # per range or part
+    TRANSFER_BACKOFF = int(environ.get("TRANSFER_BACKOFF", "2"))  # seconds, doubled per retry
+    TRANSFER_BACKOFF_MAX = int(environ.get("TRANSFER_BACKOFF_MAX", "60"))  # seconds
+    TRANSFER_STATE_INTERVAL = int(environ.get("TRANSFER_STATE_INTERVAL", "32"))  # upload parts per state save
+    # pyrogram runs every stream_media/save_file call under one semaphore of this size,
+    # so it has to cover each connection of every download, prefetch and streamed encode
+    MAX_CONCURRENT_TRANSMISSIONS = int(environ.get(
+        "MAX_CONCURRENT_TRANSMISSIONS",
+        str(TRANSFER_CONNECTIONS * (DOWNLOAD_WORKERS + PREFETCH_WORKERS + ENCODE_WORKERS))
+    ))
+    
+    # Premium scheduling (premium jobs are picked PREMIUM_WEIGHT times as often as free ones)
+    PREMIUM_WEIGHT = int(environ.get("PREMIUM_WEIGHT", "3"))
+    PREMIUM_RESERVED_WORKERS = int(environ.get("PREMIUM_RESERVED_WORKERS", "1"))
+    
+    # Persistent job queue
+    WORKER_ID = environ.get("WORKER_ID", socket.gethostname())
+    JOB_LEASE_SECONDS = int(environ.get("JOB_LEASE_SECONDS", "120"))
+    MAX_JOB_RETRIES = int(environ.get("MAX_JOB_RETRIES", "3"))
     PROGRESS_UPDATE_DELAY = int(environ.get("PROGRESS_UPDATE_DELAY", "5"))  # seconds
+    PROGRESS_GLOBAL_RATE = float(environ.get("PROGRESS_GLOBAL_RATE", "20"))  # status edits per second, all chats
+    PROGRESS_CHAT_INTERVAL = float(environ.get("PROGRESS_CHAT_INTERVAL", "1"))  # seconds between edits in one chat
     
     # Create directories
-    for directory in [DOWNLOAD_DIR, ENCODE_DIR, THUMB_DIR]:
+    for directory in [DOWNLOAD_DIR, ENCODE_DIR, THUMB_DIR, CACHE_DIR]:
         os.makedirs(directory, exist_ok=True)
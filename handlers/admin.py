@@ -3,6 +3,7 @@ from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from config import Config
 from helpers.database import Database
 from helpers.utils import humanbytes
+from helpers import runtime
 import os
 import sys
 import asyncio
@@ -31,9 +32,10 @@ async def restart_handler(client, message: Message):
 @Client.on_message(filters.command("queue") & filters.private)
 @admin_filter
 async def queue_handler(client, message: Message):
-    from bot import encoding_queue, active_processes
+    pipeline = runtime.pipeline
+    active_processes = runtime.active_processes
     
-    queue_size = encoding_queue.qsize()
+    queue_size = sum(pool.qsize() for pool in pipeline.values())
     active_count = len(active_processes)
     
     text = f"""
@@ -41,8 +43,17 @@ async def queue_handler(client, message: Message):
 
 📝 **Pᴇɴᴅɪɴɢ Tᴀsᴋs:** {queue_size}
 ⚙️ **Aᴄᴛɪᴠᴇ Tᴀsᴋs:** {active_count}
+
+**Sᴛᴀɢᴇs:**
 """
     
+    for name, pool in pipeline.items():
+        text += (
+            f"• {name.title()}: {pool.qsize()} waiting, {pool.active}/{pool.size} running\n"
+            f"   💎 {pool.queue.tier_size('premium')} premium, p95 wait {pool.queue.wait_percentile('premium'):.0f}s"
+            f" | 👤 {pool.queue.tier_size('free')} free, p95 wait {pool.queue.wait_percentile('free'):.0f}s\n"
+        )
+    
     if active_processes:
         text += "\n**Aᴄᴛɪᴠᴇ Usᴇʀs:**\n"
         for user_id in active_processes.keys():
@@ -53,20 +64,54 @@ async def queue_handler(client, message: Message):
 @Client.on_message(filters.command("clear") & filters.private)
 @admin_filter
 async def clear_queue_handler(client, message: Message):
-    from bot import encoding_queue, active_processes
+    pipeline = runtime.pipeline
     
-    # Clear queue
-    while not encoding_queue.empty():
-        try:
-            encoding_queue.get_nowait()
-        except:
-            break
+    # Clear every stage queue, dropping files of half-processed tasks
+    for pool in pipeline.values():
+        while not pool.queue.empty():
+            try:
+                await runtime.finish_task(pool.queue.get_nowait(), 'cancelled')
+            except:
+                break
     
     # Clear active processes
-    active_processes.clear()
+    runtime.active_processes.clear()
     
     await message.reply_text("✅ **Qᴜᴇᴜᴇ Cʟᴇᴀʀᴇᴅ!**")
 
+@Client.on_message(filters.command("workers") & filters.private)
+@admin_filter
+async def workers_handler(client, message: Message):
+    pipeline = runtime.pipeline
+    
+    if len(message.command) < 2:
+        text = "👷 **Cᴜʀʀᴇɴᴛ Wᴏʀᴋᴇʀs:**\n"
+        for name, pool in pipeline.items():
+            text += f"• {name.title()}: `{pool.size}`\n"
+        text += (
+            f"\n**Usᴀɢᴇ:** `/workers [stage] <count>`\n"
+            f"**Sᴛᴀɢᴇs:** {', '.join(pipeline)} (default: encode)\n"
+            f"**Exᴀᴍᴘʟᴇ:** `/workers download 8`"
+        )
+        await message.reply_text(text)
+        return
+    
+    stage = message.command[1] if len(message.command) > 2 else 'encode'
+    if stage not in pipeline:
+        await message.reply_text("⚠️ **Invalid stage!** Choose from: " + ", ".join(pipeline))
+        return
+    
+    try:
+        size = int(message.command[-1])
+        if size < 1:
+            await message.reply_text("⚠️ **Worker count must be at least 1!**")
+            return
+        
+        pipeline[stage].resize(size)
+        await message.reply_text(f"✅ **{stage.title()} ᴡᴏʀᴋᴇʀs sᴇᴛ ᴛᴏ:** `{size}`")
+    except ValueError:
+        await message.reply_text("⚠️ **Invalid worker count! Must be a number.**")
+
 # Settings Commands
 @Client.on_message(filters.command("audio") & filters.private)
 @admin_filter
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import time
+import logging
+from collections import OrderedDict
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class SourceCache:
+    """On-disk LRU cache of source files keyed by Telegram file_unique_id
+
+    Failed downloads that can be resumed stay on disk as partials. They count
+    towards max_bytes, are evicted before complete sources and expire after
+    CACHE_PARTIAL_TTL.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or Config.CACHE_DIR
+        self.max_bytes = max_bytes or Config.CACHE_MAX_BYTES
+        # key -> {'path', 'size'}, least recently used first
+        self.entries = OrderedDict()
+        # key -> {'path', 'size', 'time'} of resumable partial downloads, oldest first
+        self.partials = OrderedDict()
+        self.pins = {}
+        self.fetching = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+        self._evict()
+
+    @property
+    def total_size(self):
+        entries = sum(entry['size'] for entry in self.entries.values())
+        return entries + sum(partial['size'] for partial in self.partials.values())
+
+    def get(self, key):
+        """Path of a cached source, or None"""
+        entry = self.entries.get(key)
+        return entry['path'] if entry else None
+
+    async def acquire(self, key, size, fetch, ext='.mp4'):
+        """Pin a source and return its path, downloading it with fetch(path) if missing
+
+        Concurrent acquires of the same key share a single download, which is
+        cancelled once every acquire waiting for it has been cancelled.
+        """
+        self.pins[key] = self.pins.get(key, 0) + 1
+        try:
+            if key not in self.entries:
+                if key not in self.fetching:
+                    self.fetching[key] = asyncio.ensure_future(self._fetch(key, size, fetch, ext))
+                # A cancelled waiter must not cancel the download for the others
+                await asyncio.shield(self.fetching[key])
+
+            self.entries.move_to_end(key)
+            path = self.entries[key]['path']
+            os.utime(path)
+            return path
+        except BaseException:
+            self.release(key)
+            if not self.pins.get(key) and key in self.fetching:
+                self.fetching[key].cancel()
+            raise
+
+    def release(self, key):
+        """Unpin a source so it can be evicted again"""
+        if self.pins.get(key, 0) <= 1:
+            self.pins.pop(key, None)
+        else:
+            self.pins[key] -= 1
+        self._evict()
+
+    def _scan(self):
+        """Index sources and resumable partials left on disk by a previous run, oldest first"""
+        files = []
+        partials = []
+        names = set(os.listdir(self.directory))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            # Interrupted downloads with a .state sidecar can be resumed, other leftovers go
+            if name.endswith('.part') and f'{name}.state' in names:
+                partials.append((os.path.getmtime(f'{path}.state'), name, path))
+                continue
+            if name.endswith('.part.state') and name[:-len('.state')] in names:
+                continue
+            if name.endswith(('.part', '.temp', '.state')):
+                os.remove(path)
+            elif os.path.isfile(path):
+                files.append((os.path.getmtime(path), name, path))
+
+        for _, name, path in sorted(files):
+            key = os.path.splitext(name)[0]
+            self.entries[key] = {'path': path, 'size': os.path.getsize(path)}
+
+        for mtime, name, path in sorted(partials):
+            key = os.path.splitext(name[:-len('.part')])[0]
+            self.partials[key] = {'path': path, 'size': os.path.getsize(path), 'time': mtime}
+
+    async def _fetch(self, key, size, fetch, ext):
+        path = os.path.join(self.directory, f'{key}{ext}')
+        part_path = f'{path}.part'
+        # A partial of this key is either resumed below or stale
+        partial = self.partials.pop(key, None)
+        if partial and partial['path'] != part_path:
+            self._remove_partial(partial)
+            partial = None
+
+        cancelled = False
+        try:
+            self._evict(reserve=size - (partial['size'] if partial else 0))
+            downloaded = await fetch(part_path)
+            os.replace(downloaded or part_path, path)
+            self.entries[key] = {'path': path, 'size': os.path.getsize(path)}
+            self._evict()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            self.fetching.pop(key, None)
+            # Keep a failed download whose fetch recorded its progress for a later resume,
+            # a fetch cancelled because nobody waits for it any more is dropped
+            if os.path.exists(part_path):
+                if cancelled or not os.path.exists(f'{part_path}.state'):
+                    self._remove_partial({'path': part_path})
+                else:
+                    self.partials[key] = {'path': part_path, 'size': os.path.getsize(part_path), 'time': time.time()}
+                    self._evict()
+
+    def _remove_partial(self, partial):
+        for path in (partial['path'], f"{partial['path']}.state"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error removing {path}: {e}")
+
+    def _evict(self, reserve=0):
+        """Drop expired partials, then partials and unpinned sources, least recently used first, until within budget"""
+        expiry = time.time() - Config.CACHE_PARTIAL_TTL
+        for key in [key for key, partial in self.partials.items() if partial['time'] < expiry]:
+            self._remove_partial(self.partials.pop(key))
+
+        total = self.total_size
+        for key in list(self.partials):
+            if total + reserve <= self.max_bytes:
+                return
+            partial = self.partials.pop(key)
+            total -= partial['size']
+            self._remove_partial(partial)
+
+        for key in list(self.entries):
+            if total + reserve <= self.max_bytes:
+                return
+            if self.pins.get(key):
+                continue
+
+            entry = self.entries.pop(key)
+            total -= entry['size']
+            try:
+                os.remove(entry['path'])
+            except OSError as e:
+                logger.error(f"Error evicting {entry['path']}: {e}")
+
+        if total + reserve > self.max_bytes:
+            logger.warning(f"Source cache over budget, all {len(self.entries)} entries are pinned")
@@ -1,5 +1,7 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from datetime import datetime, timedelta
+import json
 from config import Config
 import logging
 
@@ -13,6 +15,11 @@ class Database:
         self.settings = self.db.settings
         self.premium = self.db.premium
         self.stats = self.db.stats
+        self.jobs = self.db.jobs
+        self.videos = self.db.videos
+        self.results = self.db.results
+        self.media_info = self.db.media_info
+        self.probes = self.db.probes
         
     async def add_user(self, user_id):
         """Add a new user to database"""
@@ -239,3 +246,155 @@ class Database:
             {'$set': settings_dict},
             upsert=True
         )
+    
+    # Persistent Job Queue
+    async def add_job(self, job_id, job_data):
+        """Persist a new queued job, leased to this worker"""
+        now = datetime.now()
+        await self.jobs.insert_one({
+            '_id': job_id,
+            **job_data,
+            'state': 'queued',
+            'attempts': 0,
+            'lease_owner': Config.WORKER_ID,
+            'lease_until': now + timedelta(seconds=Config.JOB_LEASE_SECONDS),
+            'error': None,
+            'created_date': now,
+            'updated_date': now
+        })
+    
+    async def get_job(self, job_id):
+        """Get job data"""
+        return await self.jobs.find_one({'_id': job_id})
+    
+    async def set_job_state(self, job_id, state, **fields):
+        """Move a job to a new state"""
+        await self.jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'state': state, 'updated_date': datetime.now(), **fields}}
+        )
+    
+    async def lease_job(self, job_id, owner, seconds):
+        """Take or renew the lease on a job, fails if another worker holds it or it has ended"""
+        now = datetime.now()
+        job = await self.jobs.find_one_and_update(
+            {
+                '_id': job_id,
+                'state': {'$nin': ['done', 'failed', 'cancelled']},
+                '$or': [
+                    {'lease_owner': None},
+                    {'lease_owner': owner},
+                    {'lease_until': {'$lt': now}}
+                ]
+            },
+            {'$set': {
+                'lease_owner': owner,
+                'lease_until': now + timedelta(seconds=seconds),
+                'updated_date': now
+            }}
+        )
+        return bool(job)
+    
+    async def finish_job(self, job_id, state, error=None):
+        """Mark a job as done, failed or cancelled and drop its lease"""
+        await self.set_job_state(job_id, state, error=error, lease_owner=None, lease_until=None)
+    
+    async def retry_job(self, job_id, error=None):
+        """Put a job back in the queue and count the attempt, the lease stays with its worker"""
+        job = await self.jobs.find_one_and_update(
+            {'_id': job_id},
+            {
+                '$set': {
+                    'state': 'queued',
+                    'error': error,
+                    'updated_date': datetime.now()
+                },
+                '$inc': {'attempts': 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        return job['attempts'] if job else 0
+    
+    async def get_recoverable_jobs(self, owner, include_own=True):
+        """Get unfinished jobs whose lease is free or expired
+        
+        With include_own, jobs still leased to owner are included too, for a
+        worker picking up its own jobs after a restart.
+        """
+        unleased = [{'lease_owner': None}, {'lease_until': {'$lt': datetime.now()}}]
+        if include_own:
+            unleased.append({'lease_owner': owner})
+        return self.jobs.find({
+            'state': {'$in': ['queued', 'downloading', 'encoding', 'uploading']},
+            '$or': unleased
+        }).sort('created_date', 1)
+    
+    # Last video sent by each user
+    async def save_user_video(self, user_id, video_data):
+        """Remember the last video a user sent"""
+        await self.videos.update_one(
+            {'user_id': user_id},
+            {'$set': {'user_id': user_id, **video_data}},
+            upsert=True
+        )
+    
+    async def get_user_video(self, user_id):
+        """Get the last video a user sent"""
+        video = await self.videos.find_one({'user_id': user_id}, {'_id': 0, 'user_id': 0})
+        return video
+    
+    # Encoded Output Cache
+    async def get_cached_result(self, key):
+        """Get the uploaded outputs of an earlier identical job"""
+        result = await self.results.find_one_and_update(
+            {'_id': key},
+            {'$inc': {'hits': 1}, '$set': {'last_hit': datetime.now()}}
+        )
+        return result.get('outputs') if result else None
+    
+    async def save_cached_result(self, key, outputs):
+        """Remember the Telegram file_ids of a job's uploaded outputs"""
+        await self.results.update_one(
+            {'_id': key},
+            {'$set': {'outputs': outputs, 'date': datetime.now()}, '$setOnInsert': {'hits': 0}},
+            upsert=True
+        )
+    
+    async def get_media_info_text(self, file_unique_id):
+        """Get the formatted media info of a source"""
+        info = await self.media_info.find_one({'_id': file_unique_id})
+        return info.get('text') if info else None
+    
+    async def save_media_info_text(self, file_unique_id, text):
+        """Remember the formatted media info of a source"""
+        await self.media_info.update_one(
+            {'_id': file_unique_id},
+            {'$set': {'text': text, 'date': datetime.now()}},
+            upsert=True
+        )
+    
+    async def get_probe(self, file_unique_id):
+        """Get the cached ffprobe data of a source"""
+        probe = await self.probes.find_one({'_id': file_unique_id})
+        return json.loads(probe['data']) if probe and 'data' in probe else None
+    
+    async def save_probe(self, file_unique_id, data):
+        """Cache the ffprobe data of a source, stored as JSON since tag names may contain dots"""
+        await self.probes.update_one(
+            {'_id': file_unique_id},
+            {'$set': {'data': json.dumps(data), 'date': datetime.now()}},
+            upsert=True
+        )
+    
+    async def get_keyframes(self, file_unique_id):
+        """Get the cached keyframe index of a source"""
+        probe = await self.probes.find_one({'_id': file_unique_id}, {'keyframes': 1})
+        return probe.get('keyframes') if probe else None
+    
+    async def save_keyframes(self, file_unique_id, keyframes):
+        """Cache the keyframe index of a source next to its ffprobe data"""
+        await self.probes.update_one(
+            {'_id': file_unique_id},
+            {'$set': {'keyframes': keyframes}},
+            upsert=True
+        )
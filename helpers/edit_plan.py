@@ -0,0 +1,144 @@
+from config import Config
+from helpers.utils import parse_time_string
+
+TEXT_POSITIONS = {
+    'top_left': 'x=10:y=10',
+    'top_right': 'x=w-tw-10:y=10',
+    'bottom_left': 'x=10:y=h-th-10',
+    'bottom_right': 'x=w-tw-10:y=h-th-10',
+    'center': 'x=(w-tw)/2:y=(h-th)/2'
+}
+
+LOGO_POSITIONS = {
+    'top_left': '10:10',
+    'top_right': 'W-w-10:10',
+    'bottom_left': '10:H-h-10',
+    'bottom_right': 'W-w-10:H-h-10',
+    'center': '(W-w)/2:(H-h)/2'
+}
+
+class EditPlan:
+    """Chain of edits compiled into one ffmpeg command with a single filter graph
+
+    Video filters run in the order they were added and the result is encoded once:
+
+        plan = EditPlan().trim('00:01:00', '00:02:30').hard_subtitle(subs).logo(logo).scale('720p')
+        await ffmpeg.run_edit_plan(plan, input_file, output_file)
+    """
+
+    def __init__(self):
+        self.start = 0
+        self.end = None
+        self.steps = []
+        self.bitrate = None
+        self.display_aspect = None
+
+    def trim(self, start_time, end_time=None):
+        """Keep start_time to end_time, as HH:MM:SS or seconds"""
+        self.start = parse_time_string(str(start_time))
+        self.end = parse_time_string(str(end_time)) if end_time else None
+        return self
+
+    def hard_subtitle(self, subtitle_file):
+        """Burn in a subtitle file"""
+        self.steps.append(('subtitles', subtitle_file))
+        return self
+
+    def text(self, text, position='bottom_right'):
+        """Draw a text watermark"""
+        pos = TEXT_POSITIONS.get(position, TEXT_POSITIONS['bottom_right'])
+        self.steps.append(('filter', f"drawtext=text={escape(text)}:fontsize=24:fontcolor=white:borderw=2:bordercolor=black:{pos}"))
+        return self
+
+    def logo(self, logo_file, position='bottom_right'):
+        """Overlay a logo image"""
+        self.steps.append(('overlay', (logo_file, LOGO_POSITIONS.get(position, LOGO_POSITIONS['bottom_right']))))
+        return self
+
+    def crop(self, aspect='16:9'):
+        """Crop the centre of the frame to an aspect ratio like 16:9"""
+        width, height = aspect.split(':')
+        self.steps.append(('filter', (
+            f"crop=w='trunc(min(iw,ih*{width}/{height})/2)*2'"
+            f":h='trunc(min(ih,iw*{height}/{width})/2)*2'"
+        )))
+        return self
+
+    def aspect(self, aspect='16:9'):
+        """Set the display aspect ratio without touching the pixels"""
+        self.display_aspect = aspect
+        return self
+
+    def scale(self, quality):
+        """Fit a quality of Config.QUALITIES, never upscaling, and use its bitrate"""
+        width, height = map(int, Config.QUALITIES[quality]['resolution'].split('x'))
+        long, short = max(width, height), min(width, height)
+        self.steps.append(('filter', (
+            f"scale=w='if(gte(iw,ih),min({long},iw),min({short},iw))'"
+            f":h='if(gte(iw,ih),min({short},ih),min({long},ih))'"
+            f":force_original_aspect_ratio=decrease"
+        )))
+        self.bitrate = Config.QUALITIES[quality]['bitrate']
+        return self
+
+    def duration(self, source_duration):
+        """Length of the output for a source of source_duration seconds"""
+        end = min(self.end, source_duration) if self.end and source_duration else self.end or source_duration
+        return max((end or 0) - self.start, 0)
+
+    def build(self, input_file, output_file, ffmpeg):
+        """ffmpeg command of the plan, encoded with the settings of an FFmpegHelper"""
+        cmd = ['ffmpeg']
+        # Input-side seeking only decodes from the keyframe before start
+        if self.start:
+            cmd += ['-ss', str(self.start)]
+        if self.end:
+            cmd += ['-to', str(self.end)]
+        cmd += ['-i', input_file]
+
+        graph = []
+        label = '0:v'
+        for kind, value in self.steps:
+            output = f'v{len(graph)}'
+            if kind == 'overlay':
+                logo_file, position = value
+                cmd += ['-i', logo_file]
+                graph.append(f"[{label}][{cmd.count('-i') - 1}:v]overlay={position}[{output}]")
+            elif kind == 'subtitles':
+                # Seeking resets timestamps, shift them back so cues stay in sync
+                subtitles = f"subtitles=filename={escape(value)}"
+                if self.start:
+                    subtitles = f"setpts=PTS+{self.start}/TB,{subtitles},setpts=PTS-STARTPTS"
+                graph.append(f"[{label}]{subtitles}[{output}]")
+            else:
+                graph.append(f"[{label}]{value}[{output}]")
+            label = output
+
+        if graph:
+            cmd += ['-filter_complex', ';'.join(graph), '-map', f'[{label}]']
+        else:
+            cmd += ['-map', '0:v:0']
+
+        cmd += [
+            '-map', '0:a:0?',
+            '-c:v', ffmpeg.video_codec,
+            '-preset', ffmpeg.preset,
+            '-crf', str(ffmpeg.crf)
+        ]
+        if self.bitrate:
+            cmd += ['-b:v', self.bitrate]
+        if self.display_aspect:
+            cmd += ['-aspect', self.display_aspect]
+        cmd += [
+            '-c:a', 'aac',
+            '-b:a', ffmpeg.audio_bitrate,
+            '-movflags', '+faststart',
+            '-y',
+            output_file
+        ]
+        return cmd
+
+def escape(value):
+    """Escape a filter option value for use inside a filter graph"""
+    value = ''.join('\\' + c if c in "\\':" else c for c in str(value))
+    return ''.join('\\' + c if c in "\\'[],;" else c for c in value)
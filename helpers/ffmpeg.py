@@ -1,67 +1,322 @@
 import asyncio
+import hashlib
+from collections import Counter
+import inspect
+import json
 import os
-import re
+import shutil
+import struct
 import subprocess
+import tempfile
 import time
 from config import Config
+from helpers.probe import MediaInfo, probe_cache, keyframe_before, keyframe_after, nearest_keyframe, SEEK_EPSILON
+from helpers.edit_plan import EditPlan
+from helpers.utils import parse_time_string
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Encoders that reproduce a source codec, for output joined with stream copied media
+VIDEO_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265', 'vp9': 'libvpx-vp9'}
+AUDIO_ENCODERS = {'aac': 'aac', 'mp3': 'libmp3lame', 'opus': 'libopus', 'ac3': 'ac3'}
+# Codecs whose copied and re-encoded GOPs still decode after a join in MPEG-TS
+SMART_CUT_ENCODERS = {codec: VIDEO_ENCODERS[codec] for codec in ('h264', 'hevc')}
+# ffprobe profile names -> encoder profiles, re-encoded GOPs must use the source's
+SMART_CUT_PROFILES = {
+    'h264': {
+        'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+        'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'
+    },
+    'hevc': {'Main': 'main', 'Main 10': 'main10'}
+}
+# Sample entries that allow parameter sets in band, for MP4 output of a smart cut
+SMART_CUT_TAGS = {'h264': 'avc3', 'hevc': 'hev1'}
+
+# Containers that take each codec as a stream copy, Matroska takes everything else
+AUDIO_CONTAINERS = {
+    'aac': 'm4a', 'alac': 'm4a', 'mp3': 'mp3', 'mp2': 'mp2', 'opus': 'opus', 'vorbis': 'ogg',
+    'flac': 'flac', 'ac3': 'ac3', 'eac3': 'eac3', 'dts': 'dts'
+}
+# Subtitle container and codec, mov_text only lives in MP4 so it is converted to SubRip
+SUBTITLE_CONTAINERS = {
+    'subrip': ('srt', 'copy'), 'ass': ('ass', 'copy'), 'ssa': ('ass', 'copy'), 'webvtt': ('vtt', 'copy'),
+    'mov_text': ('srt', 'srt'), 'hdmv_pgs_subtitle': ('sup', 'copy')
+}
+# Codecs the Matroska muxer rejects, tracks in them are left out of an extraction
+MATROSKA_UNSUPPORTED = {'dvb_teletext', 'eia_608', 'arib_caption', 'ttml', 'pcm_bluray', 'pcm_dvd'}
+
+class FFmpegProgress:
+    """Stats of a running ffmpeg process parsed from its -progress output"""
+    
+    def __init__(self, duration=0):
+        self.duration = duration
+        self.frame = 0
+        self.fps = 0.0
+        self.speed = 0.0
+        self.out_time = 0.0
+        self.total_size = 0
+        self.done = False
+    
+    def update(self, key, value):
+        """Apply one key=value line"""
+        try:
+            if key == 'frame':
+                self.frame = int(value)
+            elif key == 'fps':
+                self.fps = float(value)
+            elif key == 'speed':
+                self.speed = float(value.rstrip('x'))
+            elif key == 'out_time_us':
+                self.out_time = int(value) / 1000000
+            elif key == 'total_size':
+                self.total_size = int(value)
+        except ValueError:
+            # ffmpeg reports N/A until the first frames are out
+            pass
+    
+    @property
+    def percent(self):
+        if self.done:
+            return 100
+        if not self.duration:
+            return 0
+        return min(self.out_time / self.duration * 100, 99.9)
+    
+    @property
+    def eta(self):
+        """Seconds left, from the remaining media time and the speed multiplier"""
+        if not self.duration or not self.speed:
+            return None
+        return max(self.duration - self.out_time, 0) / self.speed
+    
+    def __str__(self):
+        return f"{self.percent:.1f}"
+
 class FFmpegHelper:
-    def __init__(self):
-        self.preset = Config.DEFAULT_PRESET
-        self.crf = Config.DEFAULT_CRF
-        self.audio_bitrate = Config.DEFAULT_AUDIO_BITRATE
-        self.video_codec = Config.DEFAULT_VIDEO_CODEC
-    
-    async def get_media_info(self, file_path):
-        """Get media information using ffprobe"""
+    def __init__(self, settings=None):
+        # Admin bot settings override the config defaults
+        settings = settings or {}
+        self.preset = settings.get('preset', Config.DEFAULT_PRESET)
+        self.crf = settings.get('crf', Config.DEFAULT_CRF)
+        self.audio_bitrate = settings.get('audio_bitrate', Config.DEFAULT_AUDIO_BITRATE)
+        self.video_codec = settings.get('video_codec', Config.DEFAULT_VIDEO_CODEC)
+    
+    def settings_hash(self):
+        """Short hash of the settings that change the encoded output"""
+        settings = [self.video_codec, self.preset, self.crf, self.audio_bitrate]
+        return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:12]
+    
+    async def probe(self, file_path, key=None):
+        """MediaInfo of a file from the shared probe cache, or None"""
+        return await probe_cache.probe(file_path, key)
+    
+    async def get_media_info(self, file_path, key=None):
+        """Get raw ffprobe data of a file"""
+        info = await self.probe(file_path, key)
+        return info.data if info else None
+    
+    async def get_duration(self, file_path):
+        """Get video duration in seconds"""
+        info = await self.probe(file_path)
+        return info.duration if info else 0
+    
+    async def keyframes(self, file_path, key=None):
+        """Keyframe times of a file from the shared probe cache, empty when unknown"""
+        return await probe_cache.keyframes(file_path, key) or []
+    
+    def _seek(self, keyframe):
+        """Input options that start reading exactly at a keyframe
+        
+        Without accurate seeking ffmpeg decodes from the keyframe instead of
+        dropping frames up to the target, so nothing before it is decoded.
+        """
+        return ['-noaccurate_seek', '-ss', f'{keyframe + SEEK_EPSILON:.6f}']
+    
+    def select_ladder(self, info, qualities):
+        """Drop rungs that would upscale the source and cap bitrates at the source bitrate"""
+        media = MediaInfo(info or {})
+        if not media.height:
+            return {q: dict(Config.QUALITIES[q]) for q in qualities}, []
+        
+        source_bitrate = media.bit_rate
+        
+        ladder = {}
+        skipped = []
+        for quality in qualities:
+            settings = dict(Config.QUALITIES[quality])
+            if self._exceeds(media, settings['resolution']):
+                skipped.append(quality)
+                continue
+            
+            if source_bitrate and self._parse_bitrate(settings['bitrate']) > source_bitrate:
+                settings['bitrate'] = f'{source_bitrate // 1000}k'
+            ladder[quality] = settings
+        
+        # Clamp to the best rung the source can fill, or the lowest one for tiny sources
+        if not ladder:
+            rungs = sorted(Config.QUALITIES, key=lambda q: self._sides(*map(int, Config.QUALITIES[q]['resolution'].split('x'))))
+            fitting = [q for q in rungs if not self._exceeds(media, Config.QUALITIES[q]['resolution'])]
+            fallback = fitting[-1] if fitting else rungs[0]
+            ladder[fallback] = dict(Config.QUALITIES[fallback])
+            if source_bitrate and self._parse_bitrate(ladder[fallback]['bitrate']) > source_bitrate:
+                ladder[fallback]['bitrate'] = f'{max(source_bitrate // 1000, 1)}k'
+            skipped = [q for q in skipped if q != fallback]
+        
+        return ladder, skipped
+    
+    def _sides(self, width, height):
+        """(long side, short side), so portrait and landscape frames compare alike"""
+        return max(width, height), min(width, height)
+    
+    def _exceeds(self, media, resolution):
+        """Whether a rung is larger than the source in both dimensions
+        
+        A letterboxed 1920x800 source still fills the width of a 1920x1080 rung.
+        """
+        rung_long, rung_short = self._sides(*map(int, resolution.split('x')))
+        source_long, source_short = self._sides(media.width, media.height)
+        return rung_long > source_long and rung_short > source_short
+    
+    def plan_encode(self, info, quality_settings):
+        """Pick the cheapest path giving the same result: copy, audio or encode"""
+        media = MediaInfo(info or {})
+        video = media.video
+        audio = media.audio
+        if not media.height:
+            return 'encode'
+        
+        codec_names = {'libx264': 'h264', 'libx265': 'hevc', 'libvpx-vp9': 'vp9'}
+        if video.get('codec_name') != codec_names.get(self.video_codec):
+            return 'encode'
+        
+        if video.get('pix_fmt') not in (None, 'yuv420p'):
+            return 'encode'
+        
+        # Scaling never upscales, so a source within the rung on both sides passes through unchanged
+        rung_long, rung_short = self._sides(*map(int, quality_settings['resolution'].split('x')))
+        source_long, source_short = self._sides(media.width, media.height)
+        if source_long > rung_long or source_short > rung_short:
+            return 'encode'
+        
+        source_bitrate = media.bit_rate
+        if not source_bitrate or source_bitrate > self._parse_bitrate(quality_settings['bitrate']):
+            return 'encode'
+        
+        if audio and audio.get('codec_name') != 'aac':
+            return 'audio'
+        return 'copy'
+    
+    def is_streamable(self, head):
+        """Whether a source can be read front to back from a pipe, judged from its first bytes
+        
+        Matroska/WebM, MPEG-TS and FLV always can. MP4/MOV only when the moov atom
+        comes before the media data, otherwise ffmpeg needs to seek to the end first.
+        """
+        if head[:4] == b'\x1a\x45\xdf\xa3' or head[:3] == b'FLV':
+            return True
+        if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+            return True
+        if head[4:8] != b'ftyp':
+            return False
+        
+        for box, offset, size in self._mp4_boxes(head):
+            if box == b'moov':
+                return True
+            if box == b'mdat':
+                return False
+        return False
+    
+    def mp4_tail_offset(self, head):
+        """Offset of the boxes after mdat when an MP4/MOV keeps its moov atom at the end
+        
+        None when the file is not MP4 or its moov atom is already in the head.
+        """
+        if head[4:8] != b'ftyp':
+            return None
+        
+        for box, offset, size in self._mp4_boxes(head):
+            if box == b'moov':
+                return None
+            if box == b'mdat':
+                # A size of 0 means mdat runs to the end of the file
+                return offset + size if size else None
+        return None
+    
+    def _mp4_boxes(self, head):
+        """Top-level boxes whose headers lie in head, as (type, offset, size)"""
+        offset = 0
+        while offset + 8 <= len(head):
+            size, box = struct.unpack('>I4s', head[offset:offset + 8])
+            if size == 1:
+                if offset + 16 > len(head):
+                    return
+                size = struct.unpack('>Q', head[offset + 8:offset + 16])[0]
+            yield box, offset, size
+            if size < 8:
+                return
+            offset += size
+    
+    async def remux_video(self, input_file, output_file, encode_audio=False, progress_callback=None, stdin=None, duration=0):
+        """Stream copy the video into an MP4, optionally re-encoding only the audio
+        
+        With stdin, input_file should be pipe:0 and the source is read from that
+        async iterable of chunks.
+        """
         try:
             cmd = [
-                'ffprobe',
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                file_path
+                'ffmpeg',
+                '-i', input_file,
+                '-map', '0:v:0',
+                '-map', '0:a:0?',
+                '-c:v', 'copy'
             ]
+            cmd += ['-c:a', 'aac', '-b:a', self.audio_bitrate] if encode_audio else ['-c:a', 'copy']
+            cmd += ['-movflags', '+faststart', '-y', output_file]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback, stdin=stdin)
+            if returncode != 0:
+                logger.error(f"FFmpeg remux error: {stderr}")
+                return False
             
-            stdout, stderr = await process.communicate()
+            logger.info(f"Successfully remuxed: {output_file}")
+            return True
             
-            if process.returncode == 0:
-                import json
-                return json.loads(stdout.decode())
-            else:
-                logger.error(f"FFprobe error: {stderr.decode()}")
-                return None
-                
         except Exception as e:
-            logger.error(f"Error getting media info: {e}")
-            return None
+            logger.error(f"Error remuxing video: {e}")
+            return False
     
-    async def get_duration(self, file_path):
-        """Get video duration in seconds"""
-        info = await self.get_media_info(file_path)
-        if info and 'format' in info:
-            return float(info['format'].get('duration', 0))
-        return 0
+    def _parse_bitrate(self, bitrate):
+        """Convert a bitrate like 2500k or 5M to bits per second"""
+        bitrate = str(bitrate).strip().lower()
+        multipliers = {'k': 1000, 'm': 1000 ** 2}
+        if bitrate and bitrate[-1] in multipliers:
+            return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+        return int(float(bitrate or 0))
     
-    async def encode_video(self, input_file, output_file, quality, progress_callback=None):
-        """Encode video to specified quality"""
+    def _scale_filter(self, resolution):
+        """Scale down to fit resolution, never up, turned to match portrait sources"""
+        long, short = self._sides(*map(int, resolution.split('x')))
+        return (
+            f"scale=w='if(gte(iw,ih),min({long},iw),min({short},iw))'"
+            f":h='if(gte(iw,ih),min({short},ih),min({long},ih))'"
+            f":force_original_aspect_ratio=decrease"
+        )
+    
+    async def encode_video(self, input_file, output_file, quality, progress_callback=None, quality_settings=None, stdin=None, duration=0):
+        """Encode video to specified quality
+        
+        With stdin, input_file should be pipe:0 and the source is read from that
+        async iterable of chunks.
+        """
         try:
-            quality_settings = Config.QUALITIES.get(quality, Config.QUALITIES['480p'])
+            quality_settings = quality_settings or Config.QUALITIES.get(quality, Config.QUALITIES['480p'])
             resolution = quality_settings['resolution']
             bitrate = quality_settings['bitrate']
             
             # Get video duration for progress calculation
-            duration = await self.get_duration(input_file)
+            if not duration and stdin is None:
+                duration = await self.get_duration(input_file)
             
             cmd = [
                 'ffmpeg',
@@ -69,7 +324,7 @@ class FFmpegHelper:
                 '-c:v', self.video_codec,
                 '-preset', self.preset,
                 '-crf', str(self.crf),
-                '-vf', f'scale={resolution}:force_original_aspect_ratio=decrease',
+                '-vf', self._scale_filter(resolution),
                 '-b:v', bitrate,
                 '-c:a', 'aac',
                 '-b:a', self.audio_bitrate,
@@ -78,59 +333,397 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            # Monitor progress
-            if progress_callback and duration > 0:
-                asyncio.create_task(
-                    self._monitor_encoding_progress(process, duration, progress_callback)
-                )
-            
-            stdout, stderr = await process.communicate()
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback, stdin=stdin)
             
-            if process.returncode == 0:
+            if returncode == 0:
                 logger.info(f"Successfully encoded: {output_file}")
                 return True
             else:
-                logger.error(f"FFmpeg error: {stderr.decode()}")
+                logger.error(f"FFmpeg error: {stderr}")
                 return False
                 
         except Exception as e:
             logger.error(f"Error encoding video: {e}")
             return False
     
-    async def _monitor_encoding_progress(self, process, total_duration, callback):
-        """Monitor FFmpeg encoding progress"""
-        pattern = re.compile(r'time=(\d+):(\d+):(\d+\.\d+)')
-        last_update = 0
+    async def encode_video_segmented(self, input_file, output_file, quality, progress_callback=None, quality_settings=None, work_dir=None):
+        """Encode keyframe-aligned segments in parallel and concatenate them losslessly
         
-        while True:
+        Segments are cut at keyframes from the source's keyframe index, and each
+        encoder seeks straight to its own GOP boundary in the source.
+        With a work_dir, finished segments are checkpointed in a manifest there and a
+        later call with the same work_dir only encodes the remaining segments.
+        """
+        duration = await self.get_duration(input_file)
+        if not Config.SEGMENTED_ENCODING or duration < Config.SEGMENT_MIN_DURATION:
+            return await self.encode_video(input_file, output_file, quality, progress_callback, quality_settings)
+        
+        bounds = self._segment_bounds(await self.keyframes(input_file))
+        if len(bounds) < 2:
+            return await self.encode_video(input_file, output_file, quality, progress_callback, quality_settings)
+        
+        quality_settings = quality_settings or Config.QUALITIES.get(quality, Config.QUALITIES['480p'])
+        keep_checkpoints = work_dir is not None
+        work_dir = work_dir or f'{os.path.splitext(output_file)[0]}_segments'
+        manifest_file = os.path.join(work_dir, 'manifest.json')
+        
+        # Checkpoints are only reused for the exact same encode settings
+        signature = {
+            'video_codec': self.video_codec,
+            'preset': self.preset,
+            'crf': self.crf,
+            'audio_bitrate': self.audio_bitrate,
+            'segment_duration': Config.SEGMENT_DURATION,
+            'split': 'keyframes',
+            **quality_settings
+        }
+        manifest = self._load_manifest(manifest_file)
+        if not manifest or manifest.get('signature') != signature or manifest.get('bounds') != bounds:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            segments = [f'{i:05d}' for i in range(len(bounds))]
+            manifest = {'signature': signature, 'bounds': bounds, 'segments': segments, 'done': [], 'audio_done': False}
+        else:
+            logger.info(f"Resuming {work_dir}: {len(manifest['done'])}/{len(manifest['segments'])} segments done")
+        os.makedirs(work_dir, exist_ok=True)
+        
+        success = False
+        try:
+            sources = manifest['segments']
+            encoded = {source: os.path.join(work_dir, f'encoded_{source}.mkv') for source in sources}
+            
+            # Size the pool to the machine, each encoder gets a few threads
+            workers = max(1, (os.cpu_count() or 1) // Config.SEGMENT_THREADS)
+            semaphore = asyncio.Semaphore(workers)
+            
+            # Per-segment stats are summed into one view of the whole encode
+            running = {}
+            finished = FFmpegProgress(duration)
+            finished.out_time = sum(manifest.get('durations', {}).get(source, 0) for source in manifest['done'])
+            last_update = 0
+            
+            async def report(source, progress):
+                nonlocal last_update
+                running[source] = progress
+                now = time.time()
+                if now - last_update < Config.PROGRESS_UPDATE_DELAY:
+                    return
+                last_update = now
+                
+                total = FFmpegProgress(duration)
+                total.out_time = finished.out_time + sum(p.out_time for p in running.values())
+                total.total_size = finished.total_size + sum(p.total_size for p in running.values())
+                total.frame = finished.frame + sum(p.frame for p in running.values())
+                total.fps = sum(p.fps for p in running.values())
+                total.speed = sum(p.speed for p in running.values())
+                await self._notify(progress_callback, total)
+            
+            async def run(cmd, source=None):
+                async with semaphore:
+                    callback = (lambda p: report(source, p)) if source and progress_callback else None
+                    returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=callback)
+                if returncode != 0:
+                    raise RuntimeError(stderr[-500:])
+                
+                # Checkpoint right away so a restart skips this piece
+                if source:
+                    progress = running.pop(source, None)
+                    if progress:
+                        finished.out_time += progress.out_time
+                        finished.total_size += progress.total_size
+                        finished.frame += progress.frame
+                        manifest.setdefault('durations', {})[source] = progress.out_time
+                    manifest['done'].append(source)
+                else:
+                    manifest['audio_done'] = True
+                self._save_manifest(manifest_file, manifest)
+            
+            jobs = []
+            for source, (start, end) in zip(sources, bounds):
+                if source in manifest['done'] and os.path.exists(encoded[source]):
+                    continue
+                
+                # Stop just short of the next keyframe, which starts the next segment
+                cmd = ['ffmpeg', *self._seek(start)]
+                if end is not None:
+                    cmd += ['-t', f'{end - start - SEEK_EPSILON:.6f}']
+                jobs.append(run([
+                    *cmd,
+                    '-i', input_file,
+                    '-map', '0:v:0',
+                    '-c:v', self.video_codec,
+                    '-preset', self.preset,
+                    '-crf', str(self.crf),
+                    '-vf', self._scale_filter(quality_settings['resolution']),
+                    '-b:v', quality_settings['bitrate'],
+                    '-threads', str(Config.SEGMENT_THREADS),
+                    '-an',
+                    '-y',
+                    encoded[source]
+                ], source))
+            
+            # Audio is encoded once over the whole file to avoid gaps at segment joins
+            info = await self.probe(input_file)
+            audio_file = None
+            if info and info.has_audio:
+                audio_file = os.path.join(work_dir, 'audio.m4a')
+                if not (manifest['audio_done'] and os.path.exists(audio_file)):
+                    jobs.append(run([
+                        'ffmpeg',
+                        '-i', input_file,
+                        '-map', '0:a:0',
+                        '-vn',
+                        '-c:a', 'aac',
+                        '-b:a', self.audio_bitrate,
+                        '-y',
+                        audio_file
+                    ]))
+            
+            tasks = [asyncio.ensure_future(job) for job in jobs]
             try:
-                line = await process.stderr.readline()
-                if not line:
-                    break
+                await asyncio.gather(*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+            
+            concat_file = os.path.join(work_dir, 'concat.txt')
+            with open(concat_file, 'w') as f:
+                for source in sources:
+                    f.write(f"file '{os.path.abspath(encoded[source])}'\n")
+            
+            cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', concat_file]
+            if audio_file:
+                cmd += ['-i', audio_file, '-map', '0:v', '-map', '1:a']
+            cmd += ['-c', 'copy', '-movflags', '+faststart', '-y', output_file]
+            
+            returncode, stderr = await self._run_ffmpeg(cmd)
+            if returncode != 0:
+                logger.error(f"FFmpeg concat error: {stderr}")
+                return False
+            
+            logger.info(f"Successfully encoded {len(sources)} segments with {workers} workers: {output_file}")
+            success = True
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error encoding segments: {e}")
+            return False
+        
+        finally:
+            if success or not keep_checkpoints:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _segment_bounds(self, keyframes):
+        """Keyframes about SEGMENT_DURATION apart as [start, end] pairs, end None for the last"""
+        if not keyframes:
+            return []
+        starts = [keyframes[0]]
+        for keyframe in keyframes:
+            if keyframe - starts[-1] >= Config.SEGMENT_DURATION:
+                starts.append(keyframe)
+        return [[start, end] for start, end in zip(starts, starts[1:] + [None])]
+    
+    def _load_manifest(self, manifest_file):
+        """Read a segment checkpoint manifest"""
+        try:
+            with open(manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _save_manifest(self, manifest_file, manifest):
+        """Write a segment checkpoint manifest atomically"""
+        tmp_file = f'{manifest_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, manifest_file)
+    
+    async def encode_ladder(self, input_file, outputs, progress_callback=None, ladder=None):
+        """Encode several qualities from a single decode (outputs: quality -> path)"""
+        work_files = []
+        try:
+            info = await self.probe(input_file)
+            if not info:
+                return False
+            
+            duration = info.duration
+            has_audio = info.has_audio
+            base = os.path.splitext(next(iter(outputs.values())))[0]
+            
+            # Decode once and split the frames into one scaled branch per rung
+            qualities = list(outputs)
+            ladder = ladder or {q: Config.QUALITIES[q] for q in qualities}
+            split = ''.join(f'[s{i}]' for i in range(len(qualities)))
+            graph = [f'[0:v]split={len(qualities)}{split}']
+            for i, quality in enumerate(qualities):
+                graph.append(f"[s{i}]{self._scale_filter(ladder[quality]['resolution'])}[v{i}]")
+            
+            cmd = ['ffmpeg', '-i', input_file, '-filter_complex', ';'.join(graph)]
+            
+            video_files = {}
+            for i, quality in enumerate(qualities):
+                video_files[quality] = f'{base}_{quality}_video.mp4'
+                cmd += [
+                    '-map', f'[v{i}]',
+                    '-c:v', self.video_codec,
+                    '-preset', self.preset,
+                    '-crf', str(self.crf),
+                    '-b:v', ladder[quality]['bitrate'],
+                    '-an',
+                    '-y',
+                    video_files[quality]
+                ]
+            work_files += video_files.values()
+            
+            # Audio is encoded once and shared by every rung
+            audio_file = None
+            if has_audio:
+                audio_file = f'{base}_audio.m4a'
+                work_files.append(audio_file)
+                cmd += [
+                    '-map', '0:a:0',
+                    '-vn',
+                    '-c:a', 'aac',
+                    '-b:a', self.audio_bitrate,
+                    '-y',
+                    audio_file
+                ]
+            
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback)
+            if returncode != 0:
+                logger.error(f"FFmpeg ladder error: {stderr}")
+                return False
+            
+            # Stream copy the shared audio next to each video rung
+            for quality, output_file in outputs.items():
+                cmd = ['ffmpeg', '-i', video_files[quality]]
+                if audio_file:
+                    cmd += ['-i', audio_file, '-map', '0:v', '-map', '1:a']
+                cmd += ['-c', 'copy', '-movflags', '+faststart', '-y', output_file]
                 
-                line = line.decode()
-                match = pattern.search(line)
+                returncode, stderr = await self._run_ffmpeg(cmd)
+                if returncode != 0:
+                    logger.error(f"FFmpeg mux error: {stderr}")
+                    return False
+            
+            logger.info(f"Successfully encoded ladder: {', '.join(qualities)}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error encoding ladder: {e}")
+            return False
+        
+        finally:
+            for path in work_files:
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    async def _run_ffmpeg(self, cmd, duration=0, progress_callback=None, stdin=None):
+        """Run an ffmpeg command, returns (returncode, stderr)
+        
+        Progress is read from ffmpeg's -progress key/value output on stdout, which this
+        method is the only reader of. stderr is drained separately for error logs.
+        stdin is an optional async iterable of chunks fed to the process while it runs.
+        """
+        if progress_callback and not duration and '-i' in cmd:
+            input_file = cmd[cmd.index('-i') + 1]
+            if input_file != '-' and not input_file.startswith('pipe:'):
+                duration = await self.get_duration(input_file)
+        
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        stderr_task = asyncio.create_task(self._drain(process.stderr))
+        feed_task = asyncio.create_task(self._feed(process, stdin)) if stdin is not None else None
+        progress = FFmpegProgress(duration)
+        last_update = 0
+        
+        try:
+            async for line in process.stdout:
+                key, _, value = line.decode(errors='ignore').strip().partition('=')
+                if key != 'progress':
+                    progress.update(key, value)
+                    continue
                 
-                if match:
-                    hours, minutes, seconds = match.groups()
-                    current_time = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
-                    progress = (current_time / total_duration) * 100
-                    
-                    # Update progress every 3 seconds
-                    current_time_check = time.time()
-                    if current_time_check - last_update >= 3:
-                        await callback(min(progress, 99))
-                        last_update = current_time_check
-                        
-            except Exception as e:
-                logger.error(f"Progress monitoring error: {e}")
-                break
+                # A progress=continue|end line closes one block of stats
+                progress.done = value == 'end'
+                now = time.time()
+                if progress_callback and (progress.done or now - last_update >= Config.PROGRESS_UPDATE_DELAY):
+                    last_update = now
+                    await self._notify(progress_callback, progress)
+            
+            await process.wait()
+            stderr = await stderr_task
+            if feed_task:
+                # Raises if the source failed, a truncated input must not pass as a result
+                await feed_task
+            return process.returncode, stderr
+        
+        except BaseException:
+            # A cancelled caller must not leave ffmpeg running and writing its outputs
+            if process.returncode is None:
+                process.kill()
+                await asyncio.shield(process.wait())
+            for task in (stderr_task, feed_task):
+                if task and not task.done():
+                    task.cancel()
+            raise
+    
+    async def _feed(self, process, chunks):
+        """Write chunks to the process stdin, killing it if the source fails"""
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg stopped reading, its return code tells why
+            pass
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdin.close()
+    
+    async def _drain(self, stream, limit=65536):
+        """Read a stream to the end, keeping only its tail"""
+        tail = b''
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                return tail.decode(errors='ignore')
+            tail = (tail + chunk)[-limit:]
+    
+    async def _notify(self, callback, progress):
+        """Call a sync or async progress callback without letting it break the run"""
+        try:
+            result = callback(progress)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"Progress callback error: {e}")
+    
+    async def run_edit_plan(self, plan, input_file, output_file, progress_callback=None):
+        """Apply an EditPlan in one decode and one encode"""
+        try:
+            duration = plan.duration(await self.get_duration(input_file))
+            cmd = plan.build(input_file, output_file, self)
+            
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback)
+            if returncode != 0:
+                logger.error(f"FFmpeg edit error: {stderr}")
+                return False
+            
+            logger.info(f"Successfully edited: {output_file}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error applying edits: {e}")
+            return False
     
     async def compress_video(self, input_file, output_file, target_size_mb, progress_callback=None):
         """Compress video to target file size"""
@@ -156,158 +749,403 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            if progress_callback:
-                asyncio.create_task(
-                    self._monitor_encoding_progress(process, duration, progress_callback)
-                )
-            
-            stdout, stderr = await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error compressing video: {e}")
             return False
     
-    async def add_text_watermark(self, input_file, output_file, text, position='bottom_right'):
+    async def add_text_watermark(self, input_file, output_file, text, position='bottom_right', progress_callback=None):
         """Add text watermark to video"""
+        return await self.run_edit_plan(EditPlan().text(text, position), input_file, output_file, progress_callback)
+    
+    async def add_logo_watermark(self, input_file, output_file, logo_file, position='bottom_right', progress_callback=None):
+        """Add logo watermark to video"""
+        return await self.run_edit_plan(EditPlan().logo(logo_file, position), input_file, output_file, progress_callback)
+    
+    async def trim_video(self, input_file, output_file, start_time, end_time, progress_callback=None, smart=None):
+        """Trim video from start_time to end_time (format: HH:MM:SS)
+        
+        With smart (Config.SMART_CUT by default) the cut is frame accurate, see
+        smart_trim. Otherwise stream copy can only start on a keyframe, so the cut
+        starts at the keyframe at or before start_time and nothing before it is read.
+        Without a keyframe index, as for audio, the seek goes to start_time itself.
+        """
+        if Config.SMART_CUT if smart is None else smart:
+            return await self.smart_trim(input_file, output_file, start_time, end_time, progress_callback)
+        
         try:
-            positions = {
-                'top_left': 'x=10:y=10',
-                'top_right': 'x=w-tw-10:y=10',
-                'bottom_left': 'x=10:y=h-th-10',
-                'bottom_right': 'x=w-tw-10:y=h-th-10',
-                'center': 'x=(w-tw)/2:y=(h-th)/2'
-            }
-            
-            pos = positions.get(position, positions['bottom_right'])
-            
+            start = parse_time_string(start_time)
+            keyframes = await self.keyframes(input_file)
+            if keyframes:
+                start = keyframe_before(keyframes, start)
+                seek = self._seek(start)
+            else:
+                seek = ['-ss', f'{start:.6f}']
+            length = max(parse_time_string(end_time) - start, 0)
             cmd = [
                 'ffmpeg',
+                *seek,
+                '-t', f'{length:.6f}',
                 '-i', input_file,
-                '-vf', f"drawtext=text='{text}':fontsize=24:fontcolor=white:borderw=2:bordercolor=black:{pos}",
-                '-c:a', 'copy',
+                '-c', 'copy',
                 '-y',
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, length, progress_callback)
+            return returncode == 0
             
         except Exception as e:
-            logger.error(f"Error adding watermark: {e}")
+            logger.error(f"Error trimming video: {e}")
             return False
     
-    async def add_logo_watermark(self, input_file, output_file, logo_file, position='bottom_right'):
-        """Add logo watermark to video"""
+    async def smart_trim(self, input_file, output_file, start_time, end_time, progress_callback=None):
+        """Frame accurate trim that re-encodes only the partial GOPs at both ends
+        
+        The whole GOPs in between are stream copied and the three pieces are joined
+        with the concat demuxer, so the cost is about that of a remux. The boundary
+        GOPs are encoded with the source's profile, level, refs and size, and MP4
+        output is tagged avc3/hev1 so players take the parameter sets in band.
+        Sources whose parameters cannot be matched get a full frame accurate
+        re-encode instead. The audio is stream copied over the same range.
+        """
+        work_dir = None
         try:
-            positions = {
-                'top_left': 'overlay=10:10',
-                'top_right': 'overlay=W-w-10:10',
-                'bottom_left': 'overlay=10:H-h-10',
-                'bottom_right': 'overlay=W-w-10:H-h-10',
-                'center': 'overlay=(W-w)/2:(H-h)/2'
-            }
+            info = await self.probe(input_file)
+            video = info.video if info else None
+            if not video:
+                return await self.trim_video(input_file, output_file, start_time, end_time, progress_callback, smart=False)
             
-            overlay = positions.get(position, positions['bottom_right'])
+            encoder = self._smart_cut_encoder(video)
+            if not encoder:
+                logger.info(f"Cannot match the codec parameters of {input_file}, re-encoding the cut")
+                return await self.run_edit_plan(EditPlan().trim(start_time, end_time), input_file, output_file, progress_callback)
             
-            cmd = [
-                'ffmpeg',
-                '-i', input_file,
-                '-i', logo_file,
-                '-filter_complex', overlay,
-                '-c:a', 'copy',
-                '-y',
-                output_file
-            ]
+            start = parse_time_string(start_time)
+            end = parse_time_string(end_time)
+            to_end = bool(info.duration) and end >= info.duration - SEEK_EPSILON
+            if to_end:
+                end = info.duration
+            if end <= start:
+                return False
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            # Whole GOPs run from the first keyframe after start to the last one before end
+            keyframes = await self.keyframes(input_file)
+            first = keyframe_after(keyframes, start)
+            last = info.duration if to_end else keyframe_before(keyframes, end)
+            if first is None or first >= last:
+                # Nothing to copy, re-encoding the short range is as fast
+                return await self.run_edit_plan(EditPlan().trim(start, end), input_file, output_file, progress_callback)
             
-            await process.communicate()
-            return process.returncode == 0
+            work_dir = tempfile.mkdtemp(prefix='cut_', dir=os.path.dirname(os.path.abspath(output_file)))
+            encode = ['-map', '0:v:0', *encoder, '-an', '-y']
             
-        except Exception as e:
-            logger.error(f"Error adding logo: {e}")
-            return False
-    
-    async def trim_video(self, input_file, output_file, start_time, end_time):
-        """Trim video from start_time to end_time (format: HH:MM:SS)"""
-        try:
-            cmd = [
-                'ffmpeg',
-                '-i', input_file,
-                '-ss', start_time,
-                '-to', end_time,
-                '-c', 'copy',
-                '-y',
-                output_file
-            ]
+            # MPEG-TS keeps parameter sets in band, so copied and re-encoded GOPs decode after the join
+            pieces = []
+            commands = []
+            if first - start > SEEK_EPSILON:
+                pieces.append(os.path.join(work_dir, 'head.ts'))
+                commands.append([
+                    'ffmpeg',
+                    '-ss', f'{start:.6f}',
+                    '-t', f'{first - start - SEEK_EPSILON:.6f}',
+                    '-i', input_file,
+                    *encode,
+                    pieces[-1]
+                ])
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            copy = ['-i', input_file, '-map', '0:v:0', '-c', 'copy']
+            if to_end:
+                pieces.append(os.path.join(work_dir, 'middle.ts'))
+                commands.append(['ffmpeg', *self._seek(first), *copy, '-y', pieces[-1]])
+            else:
+                # Packets are cut in decode order, so the segment muxer splits exactly on the
+                # last keyframe and whatever follows it lands in a second file that is dropped
+                pieces.append(os.path.join(work_dir, 'middle_000.ts'))
+                commands.append([
+                    'ffmpeg',
+                    *self._seek(first),
+                    '-t', f'{last - first:.6f}',
+                    *copy,
+                    '-f', 'segment',
+                    '-segment_times', f'{last - first - 2 * SEEK_EPSILON:.6f}',
+                    '-reset_timestamps', '1',
+                    '-y',
+                    os.path.join(work_dir, 'middle_%03d.ts')
+                ])
+            
+            if not to_end and end - last > SEEK_EPSILON:
+                pieces.append(os.path.join(work_dir, 'tail.ts'))
+                commands.append([
+                    'ffmpeg',
+                    *self._seek(last),
+                    '-t', f'{end - last:.6f}',
+                    '-i', input_file,
+                    *encode,
+                    pieces[-1]
+                ])
+            
+            audio_file = None
+            if info.has_audio:
+                audio_file = os.path.join(work_dir, 'audio.mka')
+                commands.append([
+                    'ffmpeg',
+                    '-ss', f'{start:.6f}',
+                    '-t', f'{end - start:.6f}',
+                    '-i', input_file,
+                    '-map', '0:a:0',
+                    '-c:a', 'copy',
+                    '-y',
+                    audio_file
+                ])
+            
+            async def run(cmd):
+                returncode, stderr = await self._run_ffmpeg(cmd)
+                if returncode != 0:
+                    raise RuntimeError(stderr[-500:])
+            
+            tasks = [asyncio.ensure_future(run(cmd)) for cmd in commands]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+            
+            concat_file = os.path.join(work_dir, 'concat.txt')
+            with open(concat_file, 'w') as f:
+                for piece in pieces:
+                    f.write(f"file '{piece}'\n")
             
-            await process.communicate()
-            return process.returncode == 0
+            cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', concat_file]
+            if audio_file:
+                cmd += ['-i', audio_file, '-map', '0:v', '-map', '1:a']
+            cmd += ['-c', 'copy']
+            if os.path.splitext(output_file)[1].lower() in ('.mp4', '.m4v', '.mov'):
+                cmd += ['-tag:v', SMART_CUT_TAGS[video['codec_name']]]
+            cmd += ['-movflags', '+faststart', '-y', output_file]
+            
+            returncode, stderr = await self._run_ffmpeg(cmd, end - start, progress_callback)
+            if returncode != 0:
+                logger.error(f"FFmpeg smart cut error: {stderr}")
+                return False
+            
+            logger.info(f"Smart cut {start:.3f}-{end:.3f}s, copied {first:.3f}-{last:.3f}s: {output_file}")
+            return True
             
         except Exception as e:
-            logger.error(f"Error trimming video: {e}")
+            logger.error(f"Error smart trimming video: {e}")
             return False
+        
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _smart_cut_encoder(self, video):
+        """Encoder options reproducing the source's codec parameters, None when they cannot be matched"""
+        codec = video.get('codec_name')
+        profile = SMART_CUT_PROFILES.get(codec, {}).get(video.get('profile'))
+        level = int(video.get('level') or 0)
+        if codec not in SMART_CUT_ENCODERS or not profile or level <= 0 or not video.get('width'):
+            return None
+        
+        args = [
+            '-c:v', SMART_CUT_ENCODERS[codec],
+            '-preset', self.preset,
+            '-crf', str(self.crf),
+            '-pix_fmt', video.get('pix_fmt') or 'yuv420p',
+            '-s', f"{video['width']}x{video['height']}",
+            '-profile:v', profile
+        ]
+        if codec == 'h264':
+            # ffprobe reports H.264 levels times 10 and HEVC levels times 30
+            args += ['-level:v', f'{level / 10:.1f}']
+            if video.get('refs'):
+                args += ['-refs', str(video['refs'])]
+        else:
+            args += ['-x265-params', f'level-idc={level / 30:.1f}']
+        return args
     
-    async def merge_videos(self, video_files, output_file):
-        """Merge multiple videos"""
+    async def merge_videos(self, video_files, output_file, progress_callback=None):
+        """Merge multiple videos, transcoding only the inputs that cannot be stream copied
+        
+        All inputs are probed at once and the most common video and audio formats
+        are the target. Inputs in another format have the differing streams
+        transcoded in parallel, inputs with the right format but another stream
+        layout are remuxed, and the rest are joined as they are. Work files go to
+        a temp dir of this merge.
+        """
+        work_dir = None
         try:
-            # Create concat file
-            concat_file = 'concat_list.txt'
+            infos = await asyncio.gather(*(self.probe(video) for video in video_files))
+            if not all(info and info.video for info in infos):
+                logger.error("Cannot merge, an input has no readable video stream")
+                return False
+            
+            target = self._merge_target(infos)
+            work_dir = tempfile.mkdtemp(prefix='merge_', dir=os.path.dirname(os.path.abspath(output_file)))
+            
+            workers = max(1, (os.cpu_count() or 1) // Config.SEGMENT_THREADS)
+            semaphore = asyncio.Semaphore(workers)
+            
+            async def run(cmd):
+                async with semaphore:
+                    returncode, stderr = await self._run_ffmpeg(cmd)
+                if returncode != 0:
+                    raise RuntimeError(stderr[-500:])
+            
+            parts = []
+            jobs = []
+            for i, (video, info) in enumerate(zip(video_files, infos)):
+                cmd = self._merge_command(video, info, target, os.path.join(work_dir, f'{i:03d}.mp4'))
+                parts.append(cmd[-1] if cmd else video)
+                if cmd:
+                    jobs.append(run(cmd))
+            
+            if jobs:
+                logger.info(f"Normalizing {len(jobs)} of {len(video_files)} merge inputs")
+            tasks = [asyncio.ensure_future(job) for job in jobs]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+            
+            concat_file = os.path.join(work_dir, 'concat.txt')
             with open(concat_file, 'w') as f:
-                for video in video_files:
-                    f.write(f"file '{video}'\n")
+                for part in parts:
+                    path = os.path.abspath(part).replace("'", "'\\''")
+                    f.write(f"file '{path}'\n")
             
+            duration = sum(info.duration for info in infos)
             cmd = [
                 'ffmpeg',
                 '-f', 'concat',
                 '-safe', '0',
                 '-i', concat_file,
+                '-map', '0:v:0',
+                '-map', '0:a:0?',
                 '-c', 'copy',
+                '-movflags', '+faststart',
                 '-y',
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            
-            # Clean up
-            os.remove(concat_file)
+            returncode, stderr = await self._run_ffmpeg(cmd, duration, progress_callback)
+            if returncode != 0:
+                logger.error(f"FFmpeg merge error: {stderr}")
+                return False
             
-            return process.returncode == 0
+            logger.info(f"Successfully merged {len(video_files)} videos: {output_file}")
+            return True
             
         except Exception as e:
             logger.error(f"Error merging videos: {e}")
             return False
+        
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _merge_video_format(self, info):
+        """Video parameters that must match for inputs to be concatenated with stream copy"""
+        video = info.video
+        rate = video.get('r_frame_rate')
+        sar = video.get('sample_aspect_ratio')
+        return (
+            video.get('codec_name'),
+            info.width,
+            info.height,
+            video.get('pix_fmt'),
+            video.get('profile'),
+            rate if rate and not rate.startswith('0/') else None,
+            sar if sar and not sar.startswith('0:') else '1:1'
+        )
     
-    async def extract_audio(self, input_file, output_file):
+    def _merge_audio_format(self, info):
+        """Audio parameters that must match for inputs to be concatenated with stream copy, None without audio"""
+        audio = info.audio
+        if not audio:
+            return None
+        return (audio.get('codec_name'), audio.get('sample_rate'), audio.get('channels'))
+    
+    def _merge_target(self, infos):
+        """Most common video and audio format, each replaced by H.264/AAC when it cannot be encoded to"""
+        video = Counter(self._merge_video_format(info) for info in infos).most_common(1)[0][0]
+        audio = Counter(self._merge_audio_format(info) for info in infos).most_common(1)[0][0]
+        
+        codec, width, height, pix_fmt, profile, rate, sar = video
+        if codec not in VIDEO_ENCODERS or codec in SMART_CUT_PROFILES and profile not in SMART_CUT_PROFILES[codec]:
+            video = ('h264', width, height, 'yuv420p', 'High', rate, sar)
+        if audio and audio[0] not in AUDIO_ENCODERS:
+            audio = ('aac', '48000', 2)
+        return video, audio
+    
+    def _merge_command(self, video, info, target, output_file):
+        """ffmpeg command bringing one merge input to the target format, None if it already is
+        
+        Video and audio are handled apart, so an input that only differs in one of
+        them keeps the other as a stream copy.
+        """
+        video_target, audio_target = target
+        video_ok = self._merge_video_format(info) == video_target
+        audio_ok = self._merge_audio_format(info) == audio_target
+        streams = info.streams()
+        # The concat demuxer pairs streams by index, so video must come first and audio second
+        layout_ok = streams[0] is info.video and (not audio_target or len(streams) > 1 and streams[1] is info.audio)
+        
+        if video_ok and audio_ok and layout_ok:
+            return None
+        
+        cmd = ['ffmpeg', '-i', video]
+        silence = audio_target and not info.has_audio
+        if silence:
+            # Silence keeps the audio track continuous across the join
+            codec, sample_rate, channels = audio_target
+            cmd += ['-f', 'lavfi', '-i', f'anullsrc=r={sample_rate}:cl={"mono" if int(channels) == 1 else "stereo"}']
+        
+        cmd += ['-map', '0:v:0']
+        if video_ok:
+            cmd += ['-c:v', 'copy']
+        else:
+            codec, width, height, pix_fmt, profile, rate, sar = video_target
+            cmd += [
+                '-vf', (
+                    f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+                    f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar={sar.replace(":", "/")}'
+                ),
+                '-c:v', VIDEO_ENCODERS[codec],
+                '-preset', self.preset,
+                '-crf', str(self.crf),
+                '-pix_fmt', pix_fmt or 'yuv420p',
+                '-threads', str(Config.SEGMENT_THREADS)
+            ]
+            if profile in SMART_CUT_PROFILES.get(codec, {}):
+                cmd += ['-profile:v', SMART_CUT_PROFILES[codec][profile]]
+            if rate:
+                cmd += ['-r', rate]
+        
+        if not audio_target:
+            cmd += ['-an']
+        elif audio_ok:
+            cmd += ['-map', '0:a:0', '-c:a', 'copy']
+        else:
+            codec, sample_rate, channels = audio_target
+            cmd += [
+                '-map', '0:a:0' if info.has_audio else '1:a:0',
+                '-c:a', AUDIO_ENCODERS[codec],
+                '-b:a', self.audio_bitrate,
+                '-ar', str(sample_rate),
+                '-ac', str(channels)
+            ]
+            if silence:
+                cmd += ['-shortest']
+        return cmd + ['-y', output_file]
+    
+    async def extract_audio(self, input_file, output_file, progress_callback=None):
         """Extract audio from video"""
         try:
             cmd = [
@@ -319,20 +1157,14 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error extracting audio: {e}")
             return False
     
-    async def remove_audio(self, input_file, output_file):
+    async def remove_audio(self, input_file, output_file, progress_callback=None):
         """Remove audio from video"""
         try:
             cmd = [
@@ -344,20 +1176,14 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error removing audio: {e}")
             return False
     
-    async def add_audio_to_video(self, video_file, audio_file, output_file):
+    async def add_audio_to_video(self, video_file, audio_file, output_file, progress_callback=None):
         """Add/Replace audio in video"""
         try:
             cmd = [
@@ -373,20 +1199,14 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error adding audio: {e}")
             return False
     
-    async def extract_subtitles(self, input_file, output_file, stream_index=0):
+    async def extract_subtitles(self, input_file, output_file, stream_index=0, progress_callback=None):
         """Extract subtitles from video"""
         try:
             cmd = [
@@ -397,20 +1217,14 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error extracting subtitles: {e}")
             return False
     
-    async def add_soft_subtitle(self, video_file, subtitle_file, output_file):
+    async def add_soft_subtitle(self, video_file, subtitle_file, output_file, progress_callback=None):
         """Add soft subtitle to video"""
         try:
             cmd = [
@@ -423,47 +1237,18 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error adding subtitle: {e}")
             return False
     
-    async def add_hard_subtitle(self, video_file, subtitle_file, output_file):
+    async def add_hard_subtitle(self, video_file, subtitle_file, output_file, progress_callback=None):
         """Burn subtitle into video"""
-        try:
-            subtitle_file = subtitle_file.replace('\\', '/').replace(':', '\\:')
-            
-            cmd = [
-                'ffmpeg',
-                '-i', video_file,
-                '-vf', f"subtitles='{subtitle_file}'",
-                '-c:a', 'copy',
-                '-y',
-                output_file
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
-            
-        except Exception as e:
-            logger.error(f"Error adding hard subtitle: {e}")
-            return False
+        return await self.run_edit_plan(EditPlan().hard_subtitle(subtitle_file), video_file, output_file, progress_callback)
     
-    async def remove_subtitles(self, input_file, output_file):
+    async def remove_subtitles(self, input_file, output_file, progress_callback=None):
         """Remove all subtitles from video"""
         try:
             cmd = [
@@ -475,45 +1260,131 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error removing subtitles: {e}")
             return False
     
-    async def generate_thumbnail(self, video_file, output_file, timestamp='00:00:01'):
-        """Generate thumbnail from video"""
+    async def generate_thumbnail(self, video_file, output_file, timestamp='00:00:01', progress_callback=None):
+        """Generate thumbnail from video, using the keyframe nearest to timestamp
+        
+        Only that one keyframe is decoded. Without a keyframe index the seek is
+        still done on the input, decoding from the keyframe before timestamp.
+        """
         try:
+            seconds = parse_time_string(timestamp)
+            keyframes = await self.keyframes(video_file)
+            seek = self._seek(nearest_keyframe(keyframes, seconds)) if keyframes else ['-ss', f'{seconds:.6f}']
             cmd = [
                 'ffmpeg',
+                *seek,
                 '-i', video_file,
-                '-ss', timestamp,
                 '-vframes', '1',
                 '-y',
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error generating thumbnail: {e}")
             return False
     
-    async def change_aspect_ratio(self, input_file, output_file, aspect='16:9'):
+    async def extract_all(self, input_file, output_dir, thumbnails=5, progress_callback=None):
+        """Extract every audio and subtitle track and some thumbnails in one read of the file
+        
+        Tracks are stream copied into a container that fits their codec, tracks
+        that no container here can hold are skipped. Thumbnails are keyframes
+        spread over the video, and only keyframes are decoded. Files left in
+        output_dir by an earlier run are replaced. Returns a manifest of the files written, or None on failure:
+        
+            {'audio': [{'path', 'codec', 'language', 'stream'}], 'subtitles': [...], 'thumbnails': [paths]}
+        """
+        try:
+            info = await self.probe(input_file)
+            if not info:
+                return None
+            
+            os.makedirs(output_dir, exist_ok=True)
+            manifest = {'audio': [], 'subtitles': [], 'thumbnails': []}
+            cmd = ['ffmpeg', '-skip_frame', 'nokey', '-i', input_file]
+            
+            def extractable(stream, containers):
+                codec = stream.get('codec_name')
+                if codec in containers or codec and codec not in MATROSKA_UNSUPPORTED:
+                    return True
+                logger.warning(f"Skipping {stream.get('codec_type')} stream {stream['index']}, no container for {codec}")
+                return False
+            
+            audio = [stream for stream in info.streams('audio') if extractable(stream, AUDIO_CONTAINERS)]
+            subtitles = [stream for stream in info.streams('subtitle') if extractable(stream, SUBTITLE_CONTAINERS)]
+            # Cover art is a video stream too, thumbnails come from the real video
+            video = next((
+                stream for stream in info.streams('video')
+                if not stream.get('disposition', {}).get('attached_pic')
+            ), None)
+            
+            for n, stream in enumerate(audio):
+                codec = stream.get('codec_name')
+                language = stream.get('tags', {}).get('language', 'und')
+                path = os.path.join(output_dir, f"audio_{n:02d}_{language}.{AUDIO_CONTAINERS.get(codec, 'mka')}")
+                cmd += ['-map', f"0:{stream['index']}", '-c', 'copy', '-y', path]
+                manifest['audio'].append({'path': path, 'codec': codec, 'language': language, 'stream': stream['index']})
+            
+            for n, stream in enumerate(subtitles):
+                codec = stream.get('codec_name')
+                language = stream.get('tags', {}).get('language', 'und')
+                extension, subtitle_codec = SUBTITLE_CONTAINERS.get(codec, ('mks', 'copy'))
+                path = os.path.join(output_dir, f'subtitle_{n:02d}_{language}.{extension}')
+                cmd += ['-map', f"0:{stream['index']}", '-c', subtitle_codec, '-y', path]
+                manifest['subtitles'].append({'path': path, 'codec': codec, 'language': language, 'stream': stream['index']})
+            
+            thumbnail_paths = [os.path.join(output_dir, f'thumb_{n:02d}.jpg') for n in range(1, thumbnails + 1)]
+            if thumbnails and video:
+                # Keep the first keyframe and then one every duration / thumbnails seconds
+                interval = info.duration / thumbnails if info.duration else 0
+                cmd += [
+                    '-map', f"0:{video['index']}",
+                    '-vf', f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{interval:.3f})'",
+                    '-fps_mode', 'vfr',
+                    '-frames:v', str(thumbnails),
+                    '-y',
+                    os.path.join(output_dir, 'thumb_%02d.jpg')
+                ]
+            
+            if '-map' not in cmd:
+                return manifest
+            
+            # Outputs that get no packets are not written, so a file from an earlier run would pass for this one's
+            tracks = manifest['audio'] + manifest['subtitles']
+            for path in [track['path'] for track in tracks] + thumbnail_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            
+            returncode, stderr = await self._run_ffmpeg(cmd, info.duration, progress_callback)
+            if returncode != 0:
+                logger.error(f"FFmpeg extract error: {stderr}")
+                return None
+            
+            # Tracks without packets produce no file
+            manifest['audio'] = [track for track in manifest['audio'] if os.path.exists(track['path'])]
+            manifest['subtitles'] = [track for track in manifest['subtitles'] if os.path.exists(track['path'])]
+            manifest['thumbnails'] = [path for path in thumbnail_paths if os.path.exists(path)]
+            
+            logger.info(
+                f"Extracted {len(manifest['audio'])} audio, {len(manifest['subtitles'])} subtitle "
+                f"and {len(manifest['thumbnails'])} thumbnail files from {input_file}"
+            )
+            return manifest
+            
+        except Exception as e:
+            logger.error(f"Error extracting streams: {e}")
+            return None
+    
+    async def change_aspect_ratio(self, input_file, output_file, aspect='16:9', progress_callback=None):
         """Change video aspect ratio"""
         try:
             cmd = [
@@ -525,14 +1396,8 @@ class FFmpegHelper:
                 output_file
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            await process.communicate()
-            return process.returncode == 0
+            returncode, stderr = await self._run_ffmpeg(cmd, progress_callback=progress_callback)
+            return returncode == 0
             
         except Exception as e:
             logger.error(f"Error changing aspect ratio: {e}")
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class Prefetcher:
+    """Speculative downloads of a user's latest source into the source cache
+
+    A prefetch pins its source until the user's job takes it over, the user sends
+    another file, or the user does not pick an action within the TTL.
+    """
+
+    def __init__(self, cache, concurrency=None, ttl=None, max_size=None):
+        self.cache = cache
+        self.ttl = ttl or Config.PREFETCH_TTL
+        self.max_size = max_size or Config.PREFETCH_MAX_SIZE
+        self.semaphore = asyncio.Semaphore(concurrency or Config.PREFETCH_WORKERS)
+        # user_id -> {'key', 'task', 'timer'}
+        self.prefetches = {}
+
+    def start(self, user_id, key, size, fetch, ext='.mp4'):
+        """Prefetch a user's new source, replacing their previous prefetch"""
+        self.cancel(user_id)
+        if not Config.PREFETCH or (size or 0) > self.max_size or self.cache.get(key):
+            return
+
+        task = asyncio.create_task(self._prefetch(key, size, fetch, ext))
+        timer = asyncio.get_running_loop().call_later(self.ttl, self.cancel, user_id)
+        self.prefetches[user_id] = {'key': key, 'task': task, 'timer': timer}
+
+    def keep(self, user_id):
+        """The user picked an action, hold the prefetch until their job takes it over"""
+        prefetch = self.prefetches.get(user_id)
+        if prefetch:
+            prefetch['timer'].cancel()
+
+    def cancel(self, user_id):
+        """Drop a user's prefetch, its download stops unless a job shares it"""
+        prefetch = self.prefetches.pop(user_id, None)
+        if prefetch:
+            prefetch['timer'].cancel()
+            prefetch['task'].cancel()
+
+    async def _prefetch(self, key, size, fetch, ext):
+        async with self.semaphore:
+            try:
+                await self.cache.acquire(key, size, fetch, ext)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Prefetch of {key} failed: {e}")
+                return
+
+        # Keep the source pinned until cancelled
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            self.cache.release(key)
@@ -0,0 +1,233 @@
+import asyncio
+import bisect
+import json
+import os
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Seek targets are nudged past a keyframe so rounding never lands on the one before
+SEEK_EPSILON = 0.001
+
+class MediaInfo:
+    """Typed view of ffprobe output"""
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def format(self):
+        return self.data.get('format', {})
+
+    def streams(self, codec_type=None):
+        """Streams of the source, optionally only those of one codec type"""
+        return [
+            stream for stream in self.data.get('streams', [])
+            if codec_type is None or stream.get('codec_type') == codec_type
+        ]
+
+    @property
+    def video(self):
+        """First video stream, or None"""
+        return next(iter(self.streams('video')), None)
+
+    @property
+    def audio(self):
+        """First audio stream, or None"""
+        return next(iter(self.streams('audio')), None)
+
+    @property
+    def has_audio(self):
+        return self.audio is not None
+
+    @property
+    def duration(self):
+        """Duration in seconds, 0 when unknown"""
+        return float(self.format.get('duration', 0) or 0)
+
+    @property
+    def width(self):
+        return int(self.video.get('width', 0)) if self.video else 0
+
+    @property
+    def height(self):
+        return int(self.video.get('height', 0)) if self.video else 0
+
+    @property
+    def resolution(self):
+        """WIDTHxHEIGHT of the first video stream, or None"""
+        return f"{self.width}x{self.height}" if self.height else None
+
+    @property
+    def bit_rate(self):
+        """Video stream bitrate, falling back to the container bitrate"""
+        video = self.video or {}
+        return int(video.get('bit_rate') or self.format.get('bit_rate') or 0)
+
+class ProbeCache:
+    """ffprobe results and keyframe indexes kept in memory and MongoDB
+
+    Results are keyed by the Telegram file_unique_id when it is known, directly or
+    through alias(path, key), and persisted. Other files are keyed by path, size
+    and mtime and only kept in memory.
+    """
+
+    def __init__(self, max_entries=512):
+        self.db = None
+        self.max_entries = max_entries
+        # (kind, key) -> result, least recently used first
+        self.memory = OrderedDict()
+        self.aliases = {}
+        self.probing = {}
+
+    def attach(self, db):
+        """Persist results of known sources in this Database"""
+        self.db = db
+
+    def alias(self, path, key):
+        """Record that a local file is the source with this file_unique_id"""
+        self.aliases[os.path.abspath(path)] = key
+
+    async def probe(self, path, key=None):
+        """MediaInfo of a file, or None when ffprobe cannot read it"""
+        data = await self._cached('probe', path, key, ffprobe)
+        return MediaInfo(data) if data else None
+
+    async def keyframes(self, path, key=None):
+        """Sorted keyframe times of the first video stream, or None when unknown
+
+        Times are relative to the start of the file, as ffmpeg's -ss expects them.
+        """
+        return await self._cached('keyframes', path, key, ffprobe_keyframes)
+
+    async def _cached(self, kind, path, key, loader):
+        key = key or self.aliases.get(os.path.abspath(path))
+        persistent = key is not None
+        if not persistent:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        entry = (kind, key)
+        if entry in self.memory:
+            self.memory.move_to_end(entry)
+            return self.memory[entry]
+
+        # Concurrent requests for the same file share one ffprobe run
+        if entry not in self.probing:
+            self.probing[entry] = asyncio.ensure_future(self._load(kind, path, key, persistent, loader))
+        try:
+            return await asyncio.shield(self.probing[entry])
+        finally:
+            if entry in self.probing and self.probing[entry].done():
+                del self.probing[entry]
+
+    async def _load(self, kind, path, key, persistent, loader):
+        data = None
+        if persistent and self.db:
+            try:
+                data = await getattr(self.db, f'get_{kind}')(key)
+            except Exception as e:
+                logger.error(f"Error reading cached {kind} of {key}: {e}")
+
+        if data is None:
+            data = await loader(path)
+            if data and persistent and self.db:
+                try:
+                    await getattr(self.db, f'save_{kind}')(key, data)
+                except Exception as e:
+                    logger.error(f"Error caching {kind} of {key}: {e}")
+
+        if data:
+            self.memory[(kind, key)] = data
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+        return data
+
+async def ffprobe(path):
+    """Run ffprobe on a local file, returns its JSON output or None"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe',
+            '-v', 'quiet',
+            '-print_format', 'json',
+            '-show_format',
+            '-show_streams',
+            path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+
+        if process.returncode == 0:
+            return json.loads(stdout.decode())
+        logger.error(f"FFprobe error: {stderr.decode()}")
+        return None
+
+    except Exception as e:
+        logger.error(f"Error getting media info: {e}")
+        return None
+
+async def ffprobe_keyframes(path):
+    """Keyframe times of the first video stream from a packet scan, or None
+
+    Only packet headers are read, nothing is decoded, and the CSV output is
+    parsed line by line as ffprobe writes it, keeping just the keyframes.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,dts_time,flags:format=start_time',
+            '-of', 'csv=p=0',
+            path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        stderr_task = asyncio.create_task(process.stderr.read())
+        # Packet lines are pts_time,dts_time,flags, the format section ends with start_time
+        keyframes = set()
+        start = 0
+        async for line in process.stdout:
+            fields = line.decode(errors='ignore').strip().split(',')
+            if len(fields) == 1:
+                start = float(fields[0]) if fields[0] not in ('', 'N/A') else 0
+                continue
+            pts, dts, flags = fields[0], fields[1], fields[-1]
+            timestamp = pts if pts != 'N/A' else dts
+            if 'K' in flags and timestamp != 'N/A':
+                keyframes.add(float(timestamp))
+
+        stderr = await stderr_task
+        await process.wait()
+        if process.returncode != 0:
+            logger.error(f"FFprobe packet scan error: {stderr.decode()}")
+            return None
+        return sorted({round(max(keyframe - start, 0), 6) for keyframe in keyframes}) or None
+
+    except Exception as e:
+        logger.error(f"Error indexing keyframes: {e}")
+        return None
+
+def keyframe_before(keyframes, seconds):
+    """Last keyframe at or before seconds, 0 without an index"""
+    index = bisect.bisect_right(keyframes or [], seconds + SEEK_EPSILON) - 1
+    return keyframes[index] if index >= 0 else 0
+
+def keyframe_after(keyframes, seconds):
+    """First keyframe at or after seconds, None when there is none"""
+    index = bisect.bisect_left(keyframes or [], seconds - SEEK_EPSILON)
+    return keyframes[index] if keyframes and index < len(keyframes) else None
+
+def nearest_keyframe(keyframes, seconds):
+    """Keyframe closest to seconds, 0 without an index"""
+    before = keyframe_before(keyframes, seconds)
+    after = keyframe_after(keyframes, seconds)
+    return after if after is not None and after - seconds < seconds - before else before
+
+probe_cache = ProbeCache()
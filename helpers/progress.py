@@ -0,0 +1,203 @@
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from pyrogram.errors import FloodWait, MessageNotModified
+from config import Config
+from helpers.utils import humanbytes, time_formatter, progress_bar
+
+logger = logging.getLogger(__name__)
+
+class ProgressUpdater:
+    """Single sender of status message edits
+
+    Progress updates are merged per message so only the latest text is sent.
+    Edits are paced by a global rate, a per-chat interval and PROGRESS_UPDATE_DELAY
+    per message, and text that is already shown is never sent again.
+    """
+
+    def __init__(self, global_rate=None, chat_interval=None, message_interval=None):
+        self.global_interval = 1 / (global_rate or Config.PROGRESS_GLOBAL_RATE)
+        self.chat_interval = chat_interval or Config.PROGRESS_CHAT_INTERVAL
+        self.message_interval = message_interval or Config.PROGRESS_UPDATE_DELAY
+        # (chat_id, message_id) -> (message, text), in the order messages first got an update
+        self.pending = OrderedDict()
+        # Last text shown per message, bounded to the most recent ones
+        self.shown = OrderedDict()
+        self.locks = {}
+        self.next_global = 0
+        self.next_chat = {}
+        self.next_message = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def update(self, message, text):
+        """Queue a progress edit, replacing any pending one for the same message"""
+        key = self._key(message)
+        if self.shown.get(key) == text:
+            self.pending.pop(key, None)
+            return
+
+        self.pending[key] = (message, text)
+        self.wakeup.set()
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def edit(self, message, text):
+        """Edit as soon as the global and per-chat limits allow, for stage changes and results
+
+        The edit is never dropped for rate limits: a FloodWait pauses every edit and
+        this one is sent once it is over. Errors are logged, not raised to the caller.
+        """
+        key = self._key(message)
+        self.pending.pop(key, None)
+        if self.shown.get(key) == text:
+            return
+
+        async with self._lock(key):
+            while True:
+                await self._reserve(key)
+                try:
+                    await message.edit_text(text)
+                except MessageNotModified:
+                    pass
+                except FloodWait as e:
+                    logger.warning(f"Status edits hit FloodWait, pausing for {e.value}s")
+                    self.next_global = max(self.next_global, time.monotonic() + e.value)
+                    continue
+                except Exception as e:
+                    logger.warning(f"Status edit failed: {e}")
+                    return
+                self._mark_shown(key, text)
+                return
+
+    async def delete(self, message):
+        """Delete a status message and forget its pending edits"""
+        key = self._key(message)
+        self.pending.pop(key, None)
+        async with self._lock(key):
+            await message.delete()
+        self.shown.pop(key, None)
+        self.locks.pop(key, None)
+        self.next_message.pop(key, None)
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            ready = next((
+                key for key in self.pending
+                if self.next_chat.get(key[0], 0) <= now and self.next_message.get(key, 0) <= now
+            ), None)
+
+            # Sleep until the global slot or the earliest chat/message slot opens
+            if ready is None or self.next_global > now:
+                wait = max(self.next_global - now, 0)
+                if ready is None:
+                    wait = max(wait, min(
+                        max(self.next_chat.get(key[0], 0), self.next_message.get(key, 0))
+                        for key in self.pending
+                    ) - now)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            message, text = self.pending.pop(ready)
+            self.next_global = now + self.global_interval
+            self.next_chat[ready[0]] = now + self.chat_interval
+            self.next_message[ready] = now + self.message_interval
+
+            try:
+                async with self._lock(ready):
+                    await message.edit_text(text)
+                self._mark_shown(ready, text)
+            except MessageNotModified:
+                self._mark_shown(ready, text)
+            except FloodWait as e:
+                # Back off everything, the newest text is sent once the wait is over
+                logger.warning(f"Status edits hit FloodWait, pausing for {e.value}s")
+                self.next_global = time.monotonic() + e.value
+                self.pending.setdefault(ready, (message, text))
+            except Exception as e:
+                logger.debug(f"Status edit failed: {e}")
+
+    async def _reserve(self, key):
+        """Wait for the global and chat slots and take them, skipping the per-message interval"""
+        while True:
+            now = time.monotonic()
+            wait = max(self.next_global, self.next_chat.get(key[0], 0)) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        self.next_global = now + self.global_interval
+        self.next_chat[key[0]] = now + self.chat_interval
+        self.next_message[key] = now + self.message_interval
+
+    def _key(self, message):
+        return (message.chat.id, message.id)
+
+    def _lock(self, key):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    def _mark_shown(self, key, text):
+        self.shown[key] = text
+        self.shown.move_to_end(key)
+        while len(self.shown) > 1000:
+            stale, _ = self.shown.popitem(last=False)
+            self.locks.pop(stale, None)
+            self.next_message.pop(stale, None)
+
+progress_updater = ProgressUpdater()
+
+def transfer_text(title, current, total, start_time, file_name=None, user_id=None, task_id=None):
+    """Status text of a download or upload"""
+    elapsed = time.time() - start_time
+    percent = current / total * 100 if total else 0
+    speed = current / elapsed if elapsed > 0 else 0
+    eta = (total - current) / speed if speed > 0 else 0
+
+    text = f"**{title}**\n\n"
+    if file_name:
+        text += f"`{file_name}`\n\n"
+    text += (
+        f"╭──「 {progress_bar(percent)} 」── {percent:.1f}%\n"
+        f"├ **Sᴘᴇᴇᴅ:** {humanbytes(speed)}/s\n"
+        f"├ **Sɪᴢᴇ:** {humanbytes(current)} / {humanbytes(total)}\n"
+        f"├ **ETA:** {time_formatter(eta)}\n"
+        f"{'├' if user_id else '╰'} **Eʟᴀᴘsᴇᴅ:** {time_formatter(elapsed)}"
+    )
+    if user_id:
+        text += f"\n╰ **Usᴇʀ ID:** `{user_id}`"
+    if task_id:
+        text += f"\n\n`/stop{task_id}`"
+    return text
+
+def encode_text(progress, file_name, quality, user_id, task_id):
+    """Status text of a running encode from its FFmpegProgress"""
+    return (
+        f"**2. Eɴᴄᴏᴅɪɴɢ** ⚙️\n\n"
+        f"`{file_name}`\n\n"
+        f"🎯 **Qᴜᴀʟɪᴛʏ:** {quality.upper()}\n"
+        f"╭──「 {progress_bar(progress.percent)} 」── {progress.percent:.1f}%\n"
+        f"├ **Fʀᴀᴍᴇ:** {progress.frame} @ {progress.fps:.1f} fps\n"
+        f"├ **Sᴘᴇᴇᴅ:** {progress.speed:.2f}x\n"
+        f"├ **Sɪᴢᴇ:** {humanbytes(progress.total_size)}\n"
+        f"╰ **ETA:** {time_formatter(progress.eta)}\n\n"
+        f"╭ **Tᴀsᴋ Bʏ:** User\n"
+        f"╰ **Usᴇʀ ID:** `{user_id}`\n\n"
+        f"`/stop{task_id}`"
+    )
+
+async def progress_message(current, total, status_msg, start_time, text="Processing"):
+    """Pyrogram progress callback that updates a status message through the updater"""
+    progress_updater.update(status_msg, transfer_text(text, current, total, start_time))
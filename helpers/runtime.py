@@ -0,0 +1,13 @@
+"""Job pipeline state shared between bot.py and the handler plugins
+
+bot.py fills these in when it starts. Plugins import this module rather than
+bot, which would load a second copy of bot with its own pools when the bot
+runs as __main__.
+"""
+
+# Stage name -> WorkerPool
+pipeline = {}
+# user_id -> task_id of the user's current task
+active_processes = {}
+# bot.finish_task(task, state, error=None), set by bot.py
+finish_task = None
@@ -0,0 +1,143 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from config import Config
+
+class FairScheduler:
+    """Queue with weighted premium priority and round-robin between users
+
+    With a maxsize, put() waits while that many jobs of the job's tier are queued
+    so a fast stage cannot run ahead of a slow one. Each tier has its own bound,
+    free jobs filling the queue never hold back a premium one. put_nowait()
+    never waits.
+    """
+
+    def __init__(self, premium_weight=None, maxsize=0):
+        self.weights = {
+            'premium': premium_weight or Config.PREMIUM_WEIGHT,
+            'free': 1
+        }
+        # tier -> user_id -> pending jobs of that user
+        self.tiers = {tier: OrderedDict() for tier in self.weights}
+        self.credits = {tier: 0 for tier in self.weights}
+        self.waits = {tier: deque(maxlen=200) for tier in self.weights}
+        self.getters = deque()
+        # tier -> waiting putters of that tier
+        self.putters = {tier: deque() for tier in self.weights}
+        self.maxsize = maxsize
+        self.count = 0
+
+    def qsize(self):
+        """Number of jobs waiting"""
+        return self.count
+
+    def empty(self):
+        return self.count == 0
+
+    def full(self, tier=None):
+        """Whether put() of a job in tier would wait, any tier when None"""
+        tiers = [tier] if tier else self.tiers
+        return any(0 < self.maxsize <= self.tier_size(t) for t in tiers)
+
+    def tier_size(self, tier):
+        """Number of jobs waiting in a tier"""
+        return sum(len(jobs) for jobs in self.tiers[tier].values())
+
+    async def put(self, job):
+        """Add a job, waiting for room while its tier is full"""
+        tier = self._tier(job)
+        while self.full(tier):
+            putter = asyncio.get_running_loop().create_future()
+            self.putters[tier].append(putter)
+            try:
+                await putter
+            except BaseException:
+                # Pass the slot on if it was handed to this putter before it was cancelled
+                if not putter.cancel() and not self.full(tier):
+                    self._wake_putter(tier)
+                raise
+            finally:
+                self.putters[tier].remove(putter)
+        self.put_nowait(job)
+
+    def put_nowait(self, job):
+        """Add a job to its user's lane in the job's tier"""
+        tier = self._tier(job)
+        job['enqueued_at'] = time.monotonic()
+        self.tiers[tier].setdefault(job['user_id'], deque()).append(job)
+        self.count += 1
+
+        # Wake the first worker allowed to take this job
+        for getter in self.getters:
+            if not getter[0].done() and (tier == 'premium' or not getter[1]):
+                getter[0].set_result(None)
+                break
+
+    async def get(self, premium_only=False):
+        """Wait for the next job, reserved workers only take premium jobs"""
+        while True:
+            job = self._pop(premium_only)
+            if job is not None:
+                return job
+
+            getter = (asyncio.get_running_loop().create_future(), premium_only)
+            self.getters.append(getter)
+            try:
+                await getter[0]
+            finally:
+                self.getters.remove(getter)
+
+    def get_nowait(self, premium_only=False):
+        job = self._pop(premium_only)
+        if job is None:
+            raise asyncio.QueueEmpty
+        return job
+
+    def task_done(self):
+        pass
+
+    def wait_percentile(self, tier, percentile=95):
+        """Queue wait in seconds of recently dispatched jobs of a tier"""
+        waits = sorted(self.waits[tier])
+        if not waits:
+            return 0
+        return waits[min(len(waits) - 1, math.ceil(len(waits) * percentile / 100) - 1)]
+
+    def _pop(self, premium_only):
+        tiers = [tier for tier in self.tiers if self.tiers[tier]]
+        if premium_only:
+            tiers = [tier for tier in tiers if tier == 'premium']
+        if not tiers:
+            return None
+
+        # Smooth weighted round robin between tiers that have work
+        total = 0
+        for tier in tiers:
+            self.credits[tier] += self.weights[tier]
+            total += self.weights[tier]
+        tier = max(tiers, key=lambda t: self.credits[t])
+        self.credits[tier] -= total
+
+        # Round robin between users inside the tier
+        users = self.tiers[tier]
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+
+        self.count -= 1
+        self.waits[tier].append(time.monotonic() - job.pop('enqueued_at'))
+        self._wake_putter(tier)
+        return job
+
+    def _tier(self, job):
+        return 'premium' if job.get('premium') else 'free'
+
+    def _wake_putter(self, tier):
+        for putter in self.putters[tier]:
+            if not putter.done():
+                putter.set_result(None)
+                break
@@ -0,0 +1,290 @@
+import asyncio
+import json
+import math
+import os
+import time
+import logging
+from pyrogram import raw, utils, types
+from pyrogram.errors import FloodWait, InternalServerError
+from pyrogram.session import Session
+from config import Config
+from helpers.utils import humanbytes
+
+logger = logging.getLogger(__name__)
+
+# stream_media yields the file in 1MB chunks and takes offsets in chunks
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Largest part size upload.SaveBigFilePart accepts
+UPLOAD_PART_SIZE = 512 * 1024
+UPLOAD_MAX_PARTS = 4000
+# Completed ranges are recorded next to the file so a later attempt can resume
+STATE_SUFFIX = '.state'
+
+class ParallelTransfer:
+    """Moves large Telegram files over several concurrent connections
+
+    Completed download ranges and upload parts are tracked in a .state sidecar.
+    FloodWait and network errors are retried with backoff from the last good part,
+    and a transfer started again after a failure skips what is already done.
+    """
+
+    def __init__(self, client, connections=None):
+        self.client = client
+        self.connections = max(1, connections or Config.TRANSFER_CONNECTIONS)
+
+    async def download(self, file_id, file_size, path, progress=None):
+        """Download a file by fetching ranges of chunks concurrently and writing them in place"""
+        chunks = math.ceil(file_size / DOWNLOAD_CHUNK_SIZE)
+        block_chunks = Config.TRANSFER_BLOCK_CHUNKS
+        state_path = f'{path}{STATE_SUFFIX}'
+
+        state = self._load_state(state_path)
+        if not state or state.get('size') != file_size or state.get('block_chunks') != block_chunks or not os.path.exists(path):
+            state = {'size': file_size, 'block_chunks': block_chunks, 'done': []}
+            with open(path, 'wb') as f:
+                f.truncate(file_size)
+            self._save_state(state_path, state)
+        elif state['done']:
+            logger.info(f"Resuming download of {path}, {len(state['done'])} ranges already done")
+
+        blocks = asyncio.Queue()
+        done = 0
+        for start in range(0, chunks, block_chunks):
+            count = min(block_chunks, chunks - start)
+            if start in state['done']:
+                done += min(count * DOWNLOAD_CHUNK_SIZE, file_size - start * DOWNLOAD_CHUNK_SIZE)
+            else:
+                blocks.put_nowait((start, count))
+
+        start_time = time.time()
+        fd = os.open(path, os.O_WRONLY)
+
+        async def fetch_block(start, count):
+            nonlocal done
+            index = start
+
+            async def fetch():
+                # A retry continues from the last chunk written
+                nonlocal index, done
+                async for chunk in self.client.stream_media(file_id, offset=index, limit=start + count - index):
+                    os.pwrite(fd, chunk, index * DOWNLOAD_CHUNK_SIZE)
+                    index += 1
+                    done += len(chunk)
+                    if progress:
+                        await progress(done, file_size)
+
+                if index != start + count:
+                    raise IOError(f"Range at chunk {start} ended after {index - start} of {count} chunks")
+
+            await self._retry(fetch, f"Download of {path}")
+            state['done'].append(start)
+            self._save_state(state_path, state)
+
+        async def worker():
+            while not blocks.empty():
+                await fetch_block(*blocks.get_nowait())
+
+        try:
+            await self._gather(worker() for _ in range(min(self.connections, blocks.qsize())))
+        finally:
+            os.close(fd)
+
+        remove_state(path)
+        self._log_throughput('Downloaded', file_size, start_time)
+        return path
+
+    async def download_ranges(self, file_id, file_size, path, ranges):
+        """Fetch byte ranges of a file into a sparse file of its full size"""
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(file_size)
+
+        fd = os.open(path, os.O_WRONLY)
+
+        async def fetch_range(start, end):
+            index = start // DOWNLOAD_CHUNK_SIZE
+            last = math.ceil(min(end, file_size) / DOWNLOAD_CHUNK_SIZE)
+
+            async def fetch():
+                nonlocal index
+                async for chunk in self.client.stream_media(file_id, offset=index, limit=last - index):
+                    os.pwrite(fd, chunk, index * DOWNLOAD_CHUNK_SIZE)
+                    index += 1
+
+            await self._retry(fetch, f"Range download of {path}")
+
+        try:
+            await self._gather(fetch_range(start, end) for start, end in ranges)
+        finally:
+            os.close(fd)
+        return path
+
+    async def upload(self, path, progress=None):
+        """Upload a file as big file parts over several media sessions, returns its InputFileBig"""
+        file_size = os.path.getsize(path)
+        parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        if parts > UPLOAD_MAX_PARTS:
+            raise ValueError(f"{humanbytes(file_size)} is above the upload limit")
+
+        # Telegram keeps saved parts of a file_id for a while, so a retry reuses them
+        state_path = f'{path}{STATE_SUFFIX}'
+        state = self._load_state(state_path)
+        if not state or state.get('size') != file_size:
+            state = {'size': file_size, 'file_id': self.client.rnd_id(), 'done': []}
+        elif state['done']:
+            logger.info(f"Resuming upload of {path}, {len(state['done'])} of {parts} parts already sent")
+
+        file_id = state['file_id']
+        completed = set(state['done'])
+        queue = asyncio.Queue()
+        for part in range(parts):
+            if part not in completed:
+                queue.put_nowait(part)
+
+        done = sum(min(UPLOAD_PART_SIZE, file_size - part * UPLOAD_PART_SIZE) for part in completed)
+        start_time = time.time()
+        sessions = []
+
+        async def worker(session):
+            nonlocal done
+            with open(path, 'rb') as f:
+                while not queue.empty():
+                    part = queue.get_nowait()
+                    f.seek(part * UPLOAD_PART_SIZE)
+                    data = f.read(UPLOAD_PART_SIZE)
+                    await self._retry(
+                        lambda: session.invoke(
+                            raw.functions.upload.SaveBigFilePart(
+                                file_id=file_id,
+                                file_part=part,
+                                file_total_parts=parts,
+                                bytes=data
+                            )
+                        ),
+                        f"Upload of {path}"
+                    )
+                    done += len(data)
+                    state['done'].append(part)
+                    if len(state['done']) % Config.TRANSFER_STATE_INTERVAL == 0:
+                        self._save_state(state_path, state)
+                    if progress:
+                        await progress(done, file_size)
+
+        try:
+            for _ in range(min(self.connections, queue.qsize())):
+                sessions.append(await self._retry(self._media_session, "Media session"))
+            await self._gather(worker(session) for session in sessions)
+        finally:
+            self._save_state(state_path, state)
+            for session in sessions:
+                await session.stop()
+
+        self._log_throughput('Uploaded', file_size, start_time)
+        return raw.types.InputFileBig(id=file_id, parts=parts, name=os.path.basename(path))
+
+    async def send_video(self, chat_id, path, caption='', thumb=None, duration=0, width=0, height=0, progress=None):
+        """Upload a video with upload() and send it, returns the sent Message"""
+        file = await self.upload(path, progress)
+        message = await utils.parse_text_entities(self.client, caption, None, None)
+        peer = await self.client.resolve_peer(chat_id)
+        thumb = await self.client.save_file(thumb) if thumb else None
+        random_id = self.client.rnd_id()
+
+        # The same random_id makes a retried send idempotent
+        r = await self._retry(lambda: self.client.invoke(
+            raw.functions.messages.SendMedia(
+                peer=peer,
+                media=raw.types.InputMediaUploadedDocument(
+                    mime_type='video/mp4',
+                    file=file,
+                    thumb=thumb,
+                    attributes=[
+                        raw.types.DocumentAttributeVideo(
+                            duration=int(duration),
+                            w=int(width),
+                            h=int(height),
+                            supports_streaming=True
+                        ),
+                        raw.types.DocumentAttributeFilename(file_name=os.path.basename(path))
+                    ]
+                ),
+                random_id=random_id,
+                **message
+            )
+        ), f"Sending {path}")
+
+        remove_state(path)
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.client,
+                    update.message,
+                    {user.id: user for user in r.users},
+                    {chat.id: chat for chat in r.chats}
+                )
+
+    async def _media_session(self):
+        """A separate media connection, as pyrogram's own save_file uses"""
+        session = Session(
+            self.client,
+            await self.client.storage.dc_id(),
+            await self.client.storage.auth_key(),
+            await self.client.storage.test_mode(),
+            is_media=True
+        )
+        await session.start()
+        return session
+
+    async def _retry(self, action, description):
+        """Await action() until it succeeds, waiting out FloodWait and backing off on network errors"""
+        delay = Config.TRANSFER_BACKOFF
+        for attempt in range(Config.TRANSFER_RETRIES + 1):
+            try:
+                return await action()
+            except FloodWait as e:
+                error, wait = e, e.value
+            except (asyncio.TimeoutError, OSError, InternalServerError) as e:
+                error, wait = e, delay
+                delay = min(delay * 2, Config.TRANSFER_BACKOFF_MAX)
+
+            if attempt == Config.TRANSFER_RETRIES:
+                raise error
+            logger.warning(f"{description} failed ({error}), retry {attempt + 1} in {wait}s")
+            await asyncio.sleep(wait)
+
+    def _load_state(self, state_path):
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, state_path, state):
+        """Write the sidecar atomically so a crash never leaves it half written"""
+        with open(f'{state_path}.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(f'{state_path}.tmp', state_path)
+
+    async def _gather(self, coroutines):
+        """Run workers together, cancelling the rest when one fails"""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _log_throughput(self, action, size, start_time):
+        elapsed = max(time.time() - start_time, 0.001)
+        logger.info(
+            f"{action} {humanbytes(size)} in {elapsed:.1f}s "
+            f"({humanbytes(size / elapsed)}/s over {self.connections} connections)"
+        )
+
+def remove_state(path):
+    """Forget the transfer progress recorded for a file"""
+    state_path = f'{path}{STATE_SUFFIX}'
+    if os.path.exists(state_path):
+        os.remove(state_path)
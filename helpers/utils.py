@@ -2,6 +2,7 @@ import math
 import time
 import os
 from datetime import datetime
+from helpers.probe import probe_cache
 
 def humanbytes(size):
     """Convert bytes to human readable format"""
@@ -42,70 +43,6 @@ def progress_bar(percentage):
     empty = 10 - filled
     return "●" * filled + "□" * empty
 
-async def progress_message(current, total, status_msg, start_time, text="Processing"):
-    """Update progress message"""
-    try:
-        now = time.time()
-        diff = now - start_time
-        
-        if diff < 3:  # Update every 3 seconds
-            return
-        
-        percentage = (current / total) * 100
-        speed = current / diff if diff > 0 else 0
-        eta = (total - current) / speed if speed > 0 else 0
-        
-        elapsed_time = time_formatter(diff)
-        eta_time = time_formatter(eta)
-        
-        progress_str = progress_bar(percentage)
-        
-        text_msg = (
-            f"**{text}**\n\n"
-            f"╭──「 {progress_str} 」── {percentage:.1f}%\n"
-            f"├ **Sᴘᴇᴇᴅ:** {humanbytes(speed)}/s\n"
-            f"├ **Sɪᴢᴇ:** {humanbytes(current)} / {humanbytes(total)}\n"
-            f"├ **ETA:** {eta_time}\n"
-            f"╰ **Eʟᴀᴘsᴇᴅ:** {elapsed_time}"
-        )
-        
-        await status_msg.edit_text(text_msg)
-        
-    except Exception as e:
-        pass
-
-async def progress_for_pyrogram(current, total, ud_type, message, start):
-    """Progress callback for Pyrogram"""
-    now = time.time()
-    diff = now - start
-    
-    if round(diff % 10.00) == 0 or current == total:
-        percentage = current * 100 / total
-        speed = current / diff
-        elapsed_time = round(diff) * 1000
-        time_to_completion = round((total - current) / speed) * 1000
-        estimated_total_time = elapsed_time + time_to_completion
-
-        elapsed_time = time_formatter(elapsed_time)
-        estimated_total_time = time_formatter(estimated_total_time)
-
-        progress = progress_bar(percentage)
-
-        tmp = (
-            f"**{ud_type}**\n\n"
-            f"╭──「 {progress} 」── {percentage:.1f}%\n"
-            f"├ **Sᴘᴇᴇᴅ:** {humanbytes(speed)}/s\n"
-            f"├ **Pʀᴏᴄᴇssᴇᴅ:** {humanbytes(current)}\n"
-            f"├ **Tᴏᴛᴀʟ:** {humanbytes(total)}\n"
-            f"├ **ETA:** {estimated_total_time}\n"
-            f"╰ **Eʟᴀᴘsᴇᴅ:** {elapsed_time}"
-        )
-        
-        try:
-            await message.edit_text(text=tmp)
-        except:
-            pass
-
 def get_file_info(message):
     """Extract file information from message"""
     if message.video:
@@ -245,32 +182,14 @@ def get_readable_time(seconds):
     return readable_time
 
 async def get_video_duration(file_path):
-    """Get video duration using ffprobe"""
-    try:
-        cmd = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, _ = await process.communicate()
-        return float(stdout.decode().strip())
-    except:
-        return 0
+    """Get video duration from the shared probe cache"""
+    info = await probe_cache.probe(file_path)
+    return info.duration if info else 0
 
 async def get_video_resolution(file_path):
-    """Get video resolution"""
-    try:
-        cmd = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=s=x:p=0 "{file_path}"'
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, _ = await process.communicate()
-        return stdout.decode().strip()
-    except:
-        return "Unknown"
+    """Get video resolution from the shared probe cache"""
+    info = await probe_cache.probe(file_path)
+    return info.resolution if info and info.resolution else "Unknown"
 
 def is_admin(user_id, admin_list):
     """Check if user is admin"""
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from helpers.scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+class WorkerPool:
+    """Fixed-size pool of coroutines consuming jobs from a queue"""
+
+    def __init__(self, name, handler, size, queue=None, reserved=0, maxsize=0):
+        self.name = name
+        self.handler = handler
+        self.size = max(1, size)
+        self.reserved = reserved
+        self.queue = queue if queue is not None else FairScheduler(maxsize=maxsize)
+        self.workers = {}
+        self.busy = set()
+        self._next_id = 0
+
+    @property
+    def running(self):
+        """Whether the pool has been started"""
+        return bool(self.workers)
+
+    @property
+    def active(self):
+        """Number of workers currently handling a job"""
+        return len(self.busy)
+
+    @property
+    def premium_slots(self):
+        """Workers reserved for premium jobs, at least one stays general"""
+        return min(self.reserved, self.size - 1)
+
+    def qsize(self):
+        """Number of jobs waiting in the queue"""
+        return self.queue.qsize()
+
+    async def put(self, job):
+        """Add a job to the pool queue, waiting while it is full"""
+        await self.queue.put(job)
+
+    def put_nowait(self, job):
+        """Add a job to the pool queue even when it is full"""
+        self.queue.put_nowait(job)
+
+    def start(self):
+        """Spawn workers up to the configured size"""
+        self.resize(self.size)
+
+    def resize(self, size):
+        """Grow or shrink the pool at runtime"""
+        self.size = max(1, size)
+
+        while len(self.workers) < self.size:
+            self._spawn()
+
+        excess = len(self.workers) - self.size
+        if excess <= 0:
+            return
+
+        # Idle workers are cancelled right away, busy ones exit after their job
+        for worker_id in list(self.workers):
+            if excess == 0:
+                break
+            if worker_id not in self.busy:
+                self.workers.pop(worker_id).cancel()
+                excess -= 1
+
+        logger.info(f"{self.name} pool resized to {self.size} workers")
+
+    async def stop(self):
+        """Cancel all workers"""
+        tasks = list(self.workers.values())
+        self.workers.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self):
+        self._next_id += 1
+        worker_id = self._next_id
+        self.workers[worker_id] = asyncio.create_task(self._worker(worker_id))
+
+    async def _worker(self, worker_id):
+        try:
+            while True:
+                reserved_ids = sorted(self.workers)[:self.premium_slots]
+                job = await self.queue.get(premium_only=worker_id in reserved_ids)
+                self.busy.add(worker_id)
+                try:
+                    await self.handler(job)
+                except Exception as e:
+                    logger.error(f"{self.name} worker {worker_id} error: {e}")
+                finally:
+                    self.busy.discard(worker_id)
+                    self.queue.task_done()
+
+                # Retire if the pool was shrunk while this job was running
+                if len(self.workers) > self.size:
+                    break
+        finally:
+            if self.workers.get(worker_id) is asyncio.current_task():
+                del self.workers[worker_id]
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import pytest
+from helpers.ffmpeg import FFmpegHelper
+from helpers.probe import MediaInfo
+
+def source(width, height, bit_rate=20000000):
+    return {
+        'format': {'duration': '60', 'bit_rate': str(bit_rate)},
+        'streams': [{
+            'codec_type': 'video',
+            'codec_name': 'h264',
+            'pix_fmt': 'yuv420p',
+            'width': width,
+            'height': height,
+            'bit_rate': str(bit_rate)
+        }]
+    }
+
+def test_letterboxed_source_keeps_its_full_width_rung():
+    ffmpeg = FFmpegHelper()
+    for width, height in [(1920, 800), (1920, 1036)]:
+        ladder, skipped = ffmpeg.select_ladder(source(width, height), ['720p', '1080p', '2160p'])
+        assert list(ladder) == ['720p', '1080p']
+        assert skipped == ['2160p']
+
+def test_portrait_source_is_compared_side_by_side():
+    ladder, skipped = FFmpegHelper().select_ladder(source(1080, 1920), ['1080p', '2160p'])
+    assert list(ladder) == ['1080p']
+    assert skipped == ['2160p']
+
+def test_letterboxed_source_within_rung_is_copied():
+    ffmpeg = FFmpegHelper({'video_codec': 'libx264'})
+    settings = {'resolution': '1920x1080', 'bitrate': '5000k'}
+    assert ffmpeg.plan_encode(source(1920, 800, 4000000), settings) == 'copy'
+    assert ffmpeg.plan_encode(source(2560, 1080, 4000000), settings) == 'encode'
+
+def clip(audio_rate='48000', frame_rate='25/1', audio=True):
+    data = source(1280, 720)
+    data['streams'][0].update({'profile': 'High', 'r_frame_rate': frame_rate, 'sample_aspect_ratio': '1:1'})
+    if audio:
+        data['streams'].append({'codec_type': 'audio', 'codec_name': 'aac', 'sample_rate': audio_rate, 'channels': 2})
+    return MediaInfo(data)
+
+def test_merge_transcodes_only_the_stream_that_differs():
+    ffmpeg = FFmpegHelper()
+    infos = [clip(), clip(), clip(audio_rate='44100'), clip(frame_rate='30000/1001')]
+    target = ffmpeg._merge_target(infos)
+    assert ffmpeg._merge_command('a.mp4', infos[0], target, 'out.mp4') is None
+    
+    cmd = ffmpeg._merge_command('c.mp4', infos[2], target, 'out.mp4')
+    assert cmd[cmd.index('-c:v') + 1] == 'copy'
+    assert cmd[cmd.index('-ar') + 1] == '48000'
+    
+    cmd = ffmpeg._merge_command('d.mp4', infos[3], target, 'out.mp4')
+    assert cmd[cmd.index('-c:v') + 1] == 'libx264'
+    assert cmd[cmd.index('-r') + 1] == '25/1'
+    assert cmd[cmd.index('-c:a') + 1] == 'copy'
+
+def test_merge_drops_audio_without_reencoding_when_most_inputs_are_silent():
+    ffmpeg = FFmpegHelper()
+    infos = [clip(audio=False), clip(audio=False), clip()]
+    cmd = ffmpeg._merge_command('c.mp4', infos[2], ffmpeg._merge_target(infos), 'out.mp4')
+    assert cmd[cmd.index('-c:v') + 1] == 'copy'
+    assert '-an' in cmd
+
+def count_frames(path):
+    output = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_frames',
+         '-show_entries', 'stream=nb_read_frames', '-of', 'csv=p=0', path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return int(output.strip())
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason="needs ffmpeg")
+@pytest.mark.parametrize('start, end, frames', [
+    # Head, copied middle cut on the 7s keyframe and tail
+    ('2.5', '7.5', 125),
+    # Starts and ends on keyframes, the middle is cut exactly before the 6s keyframe
+    ('2', '6', 100)
+])
+def test_smart_cut_is_frame_accurate_on_gop_aligned_source(tmp_path, start, end, frames):
+    # 25 fps with a closed GOP every second and B-frames, so keyframes sit on whole seconds
+    source = str(tmp_path / 'source.mp4')
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=size=320x240:rate=25',
+        '-f', 'lavfi', '-i', 'sine=frequency=440', '-t', '10',
+        '-c:v', 'libx264', '-profile:v', 'high', '-g', '25', '-keyint_min', '25', '-sc_threshold', '0', '-bf', '2',
+        '-c:a', 'aac', '-y', source
+    ], check=True)
+
+    output = str(tmp_path / 'cut.mp4')
+    assert asyncio.run(FFmpegHelper().smart_trim(source, output, start, end))
+    assert count_frames(output) == frames
+
+def test_extract_all_skips_cover_art_unsupported_tracks_and_stale_files(tmp_path):
+    ffmpeg = FFmpegHelper()
+    info = MediaInfo({'format': {'duration': '100'}, 'streams': [
+        {'index': 0, 'codec_type': 'video', 'disposition': {'attached_pic': 1}},
+        {'index': 1, 'codec_type': 'video'},
+        {'index': 2, 'codec_type': 'audio', 'codec_name': 'aac'},
+        {'index': 3, 'codec_type': 'subtitle', 'codec_name': 'dvb_teletext'},
+        {'index': 4, 'codec_type': 'subtitle', 'codec_name': 'subrip'}
+    ]})
+    (tmp_path / 'subtitle_00_und.srt').write_text('stale')
+    commands = []
+    
+    async def probe(path, key=None):
+        return info
+    
+    async def run(cmd, duration=0, progress_callback=None, stdin=None):
+        commands.append(cmd)
+        (tmp_path / 'audio_00_und.m4a').write_bytes(b'')
+        return 0, ''
+    
+    ffmpeg.probe = probe
+    ffmpeg._run_ffmpeg = run
+    manifest = asyncio.run(ffmpeg.extract_all('in.mkv', str(tmp_path), thumbnails=1))
+    
+    cmd = commands[0]
+    assert '0:3' not in cmd
+    assert cmd[cmd.index('-vf') - 1] == '0:1'
+    assert [track['stream'] for track in manifest['audio']] == [2]
+    assert manifest['subtitles'] == []
+
+def test_trim_without_keyframe_index_seeks_to_the_requested_start():
+    ffmpeg = FFmpegHelper()
+    commands = []
+    
+    async def keyframes(path, key=None):
+        return []
+    
+    async def run(cmd, duration=0, progress_callback=None, stdin=None):
+        commands.append(cmd)
+        return 0, ''
+    
+    ffmpeg.keyframes = keyframes
+    ffmpeg._run_ffmpeg = run
+    assert asyncio.run(ffmpeg.trim_video('in.m4a', 'out.m4a', '00:05:00', '00:06:00', smart=False))
+    
+    cmd = commands[0]
+    assert float(cmd[cmd.index('-ss') + 1]) == 300
+    assert float(cmd[cmd.index('-t') + 1]) == 60
+
+def test_cancelled_ffmpeg_run_kills_the_process(tmp_path):
+    pid_file = tmp_path / 'pid'
+    fake = tmp_path / 'ffmpeg'
+    fake.write_text(f'#!/bin/sh\necho $$ > {pid_file}\nexec sleep 30\n')
+    fake.chmod(0o755)
+    
+    async def cancel():
+        task = asyncio.ensure_future(FFmpegHelper()._run_ffmpeg([str(fake), '-y', 'out.mp4']))
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    
+    asyncio.run(cancel())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+def test_single_edits_run_as_one_step_edit_plans():
+    ffmpeg = FFmpegHelper()
+    commands = []
+    
+    async def duration(path):
+        return 60
+    
+    async def run(cmd, duration=0, progress_callback=None, stdin=None):
+        commands.append(cmd)
+        return 0, ''
+    
+    ffmpeg.get_duration = duration
+    ffmpeg._run_ffmpeg = run
+    assert asyncio.run(ffmpeg.add_text_watermark('in.mp4', 'out.mp4', 'hi', 'top_left'))
+    assert asyncio.run(ffmpeg.add_logo_watermark('in.mp4', 'out.mp4', 'logo.png', 'center'))
+    
+    text, logo = (cmd[cmd.index('-filter_complex') + 1] for cmd in commands)
+    assert text == '[0:v]drawtext=text=hi:fontsize=24:fontcolor=white:borderw=2:bordercolor=black:x=10:y=10[v0]'
+    assert logo == '[0:v][1:v]overlay=(W-w)/2:(H-h)/2[v0]'
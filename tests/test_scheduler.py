@@ -0,0 +1,18 @@
+import asyncio
+from helpers.scheduler import FairScheduler
+
+def test_full_free_tier_does_not_hold_back_premium_jobs():
+    async def run():
+        queue = FairScheduler(maxsize=2)
+        for user_id in range(2):
+            await queue.put({'user_id': user_id})
+        
+        free = asyncio.ensure_future(queue.put({'user_id': 3}))
+        await asyncio.wait_for(queue.put({'user_id': 4, 'premium': True}), 1)
+        assert not free.done()
+        
+        assert (await queue.get(premium_only=True))['user_id'] == 4
+        await queue.get()
+        await asyncio.wait_for(free, 1)
+    
+    asyncio.run(run())